@@ -1,17 +1,42 @@
+import time
+# for the startup times, so this has to be first
+STARTED = time.perf_counter()
 import discord
-import shutil
 import os
-import geopy
-from geopy.distance import geodesic
-from staticmap import StaticMap, CircleMarker
-from math import pi, log, tan, cos
-from PIL import Image, ImageDraw
+import functools
 from io import BytesIO
-from numpy import random
-from typing import Optional, Literal
+from typing import Optional, Literal, NamedTuple
 import json
-import time
+import asyncio
+import hashlib
+from collections import OrderedDict
 from random import randint
+import game_core
+from game_core import GameState, Wallet, GuildStatus, GameStatus
+from lazy import random
+from monitoring import metrics, loop_lag, profiler, start_metrics_server
+from geocoding import GeoCache, Gazetteer, NominatimBackend, GeocodingService, DestinationIndex
+from maps import tile_cache, render_map_png, RenderQueue
+from outbox import Outbox
+from game_store import GameStore
+from chatlog import ChatlogRegistry, AttachmentArchiver
+try:
+    import resource
+except ImportError:
+    # there is no resource module on windows, the memory just isn't shown there
+    resource = None
+
+startup_times = {}
+last_mark = STARTED
+
+def mark_startup(phase):
+    """Remember how long a part of the startup took (since the previous part)"""
+    global last_mark
+    now = time.perf_counter()
+    startup_times[phase] = now - last_mark
+    last_mark = now
+
+mark_startup("imports")
 
 # check if there is a token and a cards file
 if not os.path.exists("TOKEN"):
@@ -29,107 +54,436 @@ if not os.path.exists("cards.json"):
     print("The cards.json file does not exist. Please download it.")
     exit()
 
-# set the global variables
-global players, Double_IsActive, Card_IsActive, Veto_IsActive, Current_Card, Veto_EndTime, FullRoundDone
-Double_IsActive = False
-Card_IsActive = False
-Veto_IsActive = False
-Current_Card = None
-Veto_EndTime = 0
-FullRoundDone = False
+# the features that can be turned off in config.json (all on if there is no such file)
+CONFIG = {"chatlog": True, "attachments": True, "cache_all_members": False, "metrics_port": 9300}
+if os.path.exists("config.json"):
+    with open("config.json", "r") as file:
+        CONFIG.update(json.load(file))
+
+def build_intents(config):
+    """Only the intents the enabled features need, instead of all of them (no presences, typing, DMs, reactions or voice)"""
+    intents = discord.Intents.none()
+    # channels and roles (and their events)
+    intents.guilds = True
+    # members joining and leaving, and fetching them when a game starts
+    intents.members = True
+    if config["chatlog"] or config["attachments"]:
+        intents.guild_messages = True
+        intents.message_content = True
+    return intents
 
 # set up the discord bot
-intents = discord.Intents.all()
-intents.message_content = True
+intents = build_intents(CONFIG)
+# the members are cached (the member events only happen for cached members), but by default a guild's members are only loaded (chunked)
+# the first time a game command needs them, so servers that never play don't cost anything
+# cache_all_members only loads every guild at startup instead (chunk_guilds_at_startup), the cache itself stays the same: discord.py can't cache only some members (like the ones with a game role)
+member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+COMMANDS_HASH_FILE = "commands.hash"
+
+def memory_mb():
+    """The peak resident memory of the bot in MB (None on windows)"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 # took this from https://github.com/TheExplainthis/ChatGPT-Discord-Bot/blob/main/src/discordBot.py and edited it a bit, though it is quite generic
-class DiscordClient(discord.Client):
+class DiscordClient(discord.AutoShardedClient):
     def __init__(self) -> None:
-        super().__init__(intents=intents)
+        super().__init__(intents=intents, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=CONFIG["cache_all_members"])
         self.synced = False
         self.added = False
+        self.restored = False
+        self.metrics_runner = None
         self.tree = discord.app_commands.CommandTree(self)
         self.activity = discord.Activity(type=discord.ActivityType.playing, name="Jet Lag The Game!")
 
+    async def setup_hook(self):
+        mark_startup("login")
+        loop_lag.start()
+        self.count_requests()
+        if CONFIG["metrics_port"]:
+            try:
+                self.metrics_runner = await start_metrics_server(CONFIG["metrics_port"])
+            except OSError as e:
+                print(f"Could not start the metrics endpoint: {e}")
+        await self.sync_commands()
+        mark_startup("command sync")
+
+    async def sync_commands(self):
+        """Sync the commands with discord, but only if they changed since the last sync (it's a slow and rate limited request, and needed only after an update)"""
+        commands = json.dumps([self.application_id] + [command.to_dict() for command in self.tree.get_commands()], sort_keys=True)
+        digest = hashlib.sha256(commands.encode()).hexdigest()
+        try:
+            with open(COMMANDS_HASH_FILE, "r") as file:
+                stored = file.read().strip()
+        except FileNotFoundError:
+            stored = None
+        if stored == digest:
+            print("The commands didn't change, not syncing")
+        else:
+            print("Syncing")
+            await self.tree.sync()
+            with open(COMMANDS_HASH_FILE, "w") as file:
+                file.write(digest)
+        self.synced = True
+
+    def count_requests(self):
+        """Count the REST requests to discord (follow-ups and interaction responses use webhooks, those aren't counted)"""
+        request = self.http.request
+        async def counted(route, **kwargs):
+            metrics.count("jetlag_discord_requests_total", method=route.method)
+            return await request(route, **kwargs)
+        self.http.request = counted
+
+    async def close(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        # write what is left of the chatlogs before shutting down
+        await chatlogs.close()
+        await archiver.close()
+        await store.flush()
+        await geocoder.save_cache()
+        await super().close()
+
     async def on_ready(self):
         await self.wait_until_ready()
-        print("Syncing")
-        if not self.synced:
-            await self.tree.sync()
-            self.synced = True
         if not self.added:
             self.added = True
-        print(f"Synced, {self.user} is running!")
-        # check if there is a main channel
-        if not any([channel.name == "main" for channel in self.get_all_channels()]):
-            print("""There is no "main" channel. Please create one.""")
-            exit()
+        print(f"{self.user} is running!")
+        # on_ready also happens after reconnecting, the rest only has to be done once
+        if self.restored:
+            return
+        self.restored = True
+        mark_startup("connect")
+        await games.restore_all(self.guilds)
+        # check if every server has a main channel (the other servers keep working)
+        for guild in self.guilds:
+            if handles.get(guild).main is None:
+                print(f"""There is no "main" channel in {guild.name}. Please create one.""")
+        mark_startup("restore")
+        memory = memory_mb()
+        print(f"Ready after {time.perf_counter() - STARTED:.1f}s (" + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_times.items()) + ")" + (f", using {memory:.0f} MB" if memory is not None else ""))
+
+    async def on_interaction(self, interaction):
+        if "first command" not in startup_times:
+            startup_times["first command"] = time.perf_counter() - STARTED
+            print(f"First command after {startup_times['first command']:.1f}s")
+        # the buttons of the confirm prompts and the shop
+        if interaction.type == discord.InteractionType.component:
+            await prompts.dispatch(interaction)
         
 client = DiscordClient()
 
-def get_coords(city):
-    """Get the lat and lon of a location"""
-    geolocator = geopy.Nominatim(user_agent="jetlag")
-    location = geolocator.geocode(city)
-    return {'lat': location.latitude, 'lon': location.longitude}
-
-def download_map_with_points(points):
-    """Download a map with the given points and areas on it. The first point is the center, the second is red, the third is green and the fourth is yellow."""
-    width, height = 1600, 1200
-    static_map = StaticMap(width, height)
-
-    def point_to_coords(point):
-        """Took this from the static map library and edited it down. Converts the lat and lon to the x and y coords on the map image."""
-        if not (-180 <= point['lon'] <= 180):
-            point['lon'] = (point['lon'] + 180) % 360 - 180
-        x = ((point['lon'] + 180.) / 360) * pow(2, static_map.zoom)
-        px = int(round((x - static_map.x_center) * static_map.tile_size + static_map.width / 2))
-        
-        if not (-90 <= point['lat'] <= 90):
-            point['lat'] = (point['lat'] + 90) % 180 - 90
-        y = (1-log(tan(point['lat']*pi/180) + 1/cos(point['lat']*pi/180))/pi)/2*pow(2, static_map.zoom)
-        py = int(round((y - static_map.y_center) * static_map.tile_size + static_map.height / 2))
-        
-        return px, py
-    
-    for num, point in enumerate(points):
-        static_map.add_marker(CircleMarker((point['lon'], point['lat']), ["black", "red", "green", "yellow"][num], 20))
-    
-    image = static_map.render()
+geocache = GeoCache()
+# optional, download a file like cities15000.txt from geonames and save it as gazetteer.txt
+geocoder = GeocodingService(NominatimBackend(os.environ.get("NOMINATIM_DOMAIN"), os.environ.get("NOMINATIM_SCHEME")), geocache, functools.partial(Gazetteer.open, "gazetteer.txt", "gazetteer_index"))
 
-    
-    center, red, green, yellow = [point_to_coords(point) for point in points]
-    # win areas
-    rw1 = (center[0]-(center[0]-(red[0] + yellow[0]) / 2)*250, center[1]-(center[1]-(red[1] + yellow[1]) / 2)*250)
-    rw2 = (center[0]-(center[0]-(red[0] + green[0]) / 2)*250, center[1]-(center[1]-(red[1] + green[1]) / 2)*250)
-    gw1 = (center[0]-(center[0]-(green[0] + yellow[0]) / 2)*250, center[1]-(center[1]-(green[1] + yellow[1]) / 2)*250)
-    gw2 = (center[0]-(center[0]-(green[0] + red[0]) / 2)*250, center[1]-(center[1]-(green[1] + red[1]) / 2)*250)
-    yw1 = (center[0]-(center[0]-(red[0] + yellow[0]) / 2)*250, center[1]-(center[1]-(red[1] + yellow[1]) / 2)*250)
-    yw2 = (center[0]-(center[0]-(green[0] + yellow[0]) / 2)*250, center[1]-(center[1]-(green[1] + yellow[1]) / 2)*250)
-    
-    # overlay the area between center, green and gw with green at a 50% opacity
-    overlay = Image.new('RGBA', image.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
-    draw.polygon([center, rw1, rw2], fill=(150, 0, 0, 100))
-    draw.polygon([center, gw1, gw2], fill=(0, 150, 0, 100))
-    draw.polygon([center, yw1, yw2], fill=(150, 150, 0, 100))
-    image = Image.alpha_composite(image.convert('RGBA'), overlay)
-    return image
+async def get_coords(city):
+    """Get the lat and lon of a location. Raises an AttributeError if the location wasn't found"""
+    with metrics.call("geocode"):
+        return await geocoder.lookup(city)
+
+render_queue = RenderQueue()
+
+outbox = Outbox()
+
+# not too many role edits at the same time, discord.py waits for the rate limits itself but this keeps the bursts small
+role_edit_semaphore = asyncio.Semaphore(5)
+
+async def set_game_roles(guild, assignments):
+    """Give members their game role (or None for no game role), all at the same time.
+    Every member gets one edit with their full new list of roles, and members that already have the right roles are skipped."""
+    guild_handles = handles.get(guild)
+    game_roles = {role.id for role in [guild_handles.runner_role, guild_handles.chaser_role] if role is not None}
+
+    async def apply(member, role):
+        # the member objects in the players list can be old, the full list of roles is replaced so it has to be the current one
+        member = await game_status.get(guild).member(member.id)
+        current = [r for r in member.roles if not r.is_default()]
+        new = [r for r in current if r.id not in game_roles]
+        if role is not None:
+            new.append(role)
+        if {r.id for r in new} == {r.id for r in current}:
+            return member
+        async with role_edit_semaphore:
+            # the answer of the edit has the new roles
+            member = await member.edit(roles=new) or await guild.fetch_member(member.id)
+        game_status.get(guild).update_member(member)
+        return member
+
+    with metrics.call("roles"):
+        return await asyncio.gather(*[apply(member, role) for member, role in assignments])
+
+class Card(NamedTuple):
+    """One card of the deck, with the message for it already made"""
+    number: int
+    challenge: str
+    reward: int
+    picture: str
+    explanation: str
+    dice: Optional[int]
+    text: str
+
+class Deck:
+    """The cards, loaded once (and again only when the file changes).
+    With shuffled on, cards are drawn from a shuffled pile (one per guild), so no card comes back until all of them have been drawn."""
+    def __init__(self, path, shuffled=True):
+        self.path = path
+        self.shuffled = shuffled
+        self.mtime = None
+        self.cards = ()
+        self.piles = {}
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with open(self.path, "r") as file:
+            data = json.load(file)
+        cards = []
+        for number, card in sorted(data.items(), key=lambda item: int(item[0])):
+            cards.append(Card(int(number), card['Challenge'], int(card['Reward']), card['Picture'], card['Explanation'], int(card['Dice']) if 'Dice' in card else None,
+                              f"Card drawn: {card['Challenge']}\n\nPoints: {card['Reward']}\n\nPicture: {card['Picture']}\n\nExplanation: {card['Explanation']}\n"))
+        self.cards = tuple(cards)
+        self.mtime = mtime
+        # the old piles can have cards that don't exist anymore
+        self.piles = {}
+
+    def draw(self, key=None):
+        """Draw a card from the pile with this key (the guild id)"""
+        self.reload_if_changed()
+        if not self.shuffled:
+            return self.cards[randint(0, len(self.cards) - 1)]
+        pile = self.piles.setdefault(key, [])
+        if not pile:
+            pile.extend(range(len(self.cards)))
+            random.shuffle(pile)
+        return self.cards[pile.pop()]
+
+deck = Deck("cards.json")
+
+store = GameStore()
+
+class Game(GameState):
+    """Everything of the game in one guild (what used to be the global variables), so every server can run its own game at the same time.
+    The rules are in GameState (game_core.py), this adds the wallet, the game store and the map."""
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.wallet = Wallet(self.save_coins)
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        self.game_map = None
+        self.destination_index = None
+        self.wallet.reset([])
+
+    def record(self, type, **data):
+        """Record an event of this game in the game store"""
+        store.record(self.guild_id, type, **data)
+
+    def save_coins(self, player):
+        """Record the coins of a player (a row of the players list)"""
+        self.record("coins", member=player[0].id, coins=player[3])
+
+    async def get_destination_index(self):
+        """The destination index of the game, made again if it got lost somehow"""
+        if self.destination_index is None:
+            self.destination_index = DestinationIndex(await geocoder.lookup_many([player[1] for player in self.players]))
+        return self.destination_index
+
+    async def restore(self, guild):
+        """Rebuild the game from the game store after a restart"""
+        state = store.state(self.guild_id)
+        if state["players"] is None:
+            return
+        restored = []
+        for member_id, destination, role, coins in state["players"]:
+            try:
+                member = await game_status.get(guild).member(member_id)
+            except discord.HTTPException:
+                print(f"Could not restore the game in {guild.name}, player {member_id} is gone")
+                return
+            restored.append([member, destination, role, coins])
+        self.players = restored
+        self.wallet.reset(self.players)
+        self.double_active = state["double"]
+        self.card_active = state["card_active"]
+        self.current_card = next((card for card in deck.cards if card.number == state["current_card"]), None)
+        self.veto_end_time = state["veto_end"]
+        self.full_round_done = state["full_round"]
+        if state["coords"] is not None:
+            self.destination_index = DestinationIndex(state["coords"])
+        print(f"Restored the running game in {guild.name}")
+
+class GameRegistry:
+    """The Game of every guild, the commands get the one of the guild they are used in"""
+    def __init__(self):
+        self.guilds = {}
+
+    def get(self, guild):
+        if guild.id not in self.guilds:
+            self.guilds[guild.id] = Game(guild.id)
+        return self.guilds[guild.id]
+
+    async def restore_all(self, guilds):
+        """Restore the games of all guilds that have one in the game store"""
+        await asyncio.gather(*[self.get(guild).restore(guild) for guild in guilds if guild.id in store.states])
+
+games = GameRegistry()
 
 def defer(func):
     """apply "await interaction.response.defer()" to function using decorator. (this should only be done once (but then sometimes twice???). I have no idea how the heck this works but it does so fine i guess.)"""
     async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-        await interaction.response.defer()
-        await func(interaction, *args, **kwargs)
+        # the outer defer times the whole command (the one after confirm is part of it)
+        owner = metrics.current.get() is None
+        if owner:
+            metrics.begin(interaction.command.name if interaction.command is not None else "button")
+        try:
+            # a button press can already have answered (by editing the prompt)
+            if not interaction.response.is_done():
+                await interaction.response.defer()
+                if owner:
+                    metrics.observe("jetlag_time_to_defer_seconds", max(0.0, time.time() - interaction.created_at.timestamp()), command=metrics.current.get().command)
+            metrics.lap("defer")
+            await func(interaction, *args, **kwargs)
+        finally:
+            if owner:
+                metrics.finish()
     return wrapper
 
+game_status = GameStatus()
+
+class GuildHandles:
+    """The channels and roles the bot uses in a guild, found by name once and after that looked up by id.
+    Kept correct by the channel and role events, so the commands don't have to search through all channels and roles every time."""
+    CHANNELS = ["main", "runners-only", "chasers-only"]
+    ROLES = ["Runner", "Chaser"]
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel_ids = {}
+        self.role_ids = {}
+        self.resolve()
+
+    def resolve(self):
+        """Go through the channels and roles once"""
+        self.channel_ids = {channel.name: channel.id for channel in self.guild.text_channels if channel.name in GuildHandles.CHANNELS}
+        self.role_ids = {role.name: role.id for role in self.guild.roles if role.name in GuildHandles.ROLES}
+
+    def channel(self, name):
+        """The text channel with this name, or None"""
+        channel_id = self.channel_ids.get(name)
+        return self.guild.get_channel(channel_id) if channel_id is not None else None
+
+    def role(self, name):
+        """The role with this name, or None"""
+        role_id = self.role_ids.get(name)
+        return self.guild.get_role(role_id) if role_id is not None else None
+
+    @property
+    def main(self):
+        return self.channel("main")
+
+    @property
+    def runners_channel(self):
+        return self.channel("runners-only")
+
+    @property
+    def chasers_channel(self):
+        return self.channel("chasers-only")
+
+    @property
+    def runner_role(self):
+        return self.role("Runner")
+
+    @property
+    def chaser_role(self):
+        return self.role("Chaser")
+
+    def channel_added(self, channel):
+        if channel.name in GuildHandles.CHANNELS and isinstance(channel, discord.TextChannel):
+            self.channel_ids[channel.name] = channel.id
+
+    def channel_removed(self, channel):
+        if self.channel_ids.get(channel.name) == channel.id:
+            del self.channel_ids[channel.name]
+
+    def role_added(self, role):
+        if role.name in GuildHandles.ROLES:
+            self.role_ids[role.name] = role.id
+
+    def role_removed(self, role):
+        if self.role_ids.get(role.name) == role.id:
+            del self.role_ids[role.name]
+
+class HandleRegistry:
+    """The GuildHandles of every guild"""
+    def __init__(self):
+        self.guilds = {}
+
+    def get(self, guild):
+        if guild.id not in self.guilds:
+            self.guilds[guild.id] = GuildHandles(guild)
+        return self.guilds[guild.id]
+
+handles = HandleRegistry()
+
+@client.event
+async def on_guild_channel_create(channel):
+    handles.get(channel.guild).channel_added(channel)
+
+@client.event
+async def on_guild_channel_delete(channel):
+    handles.get(channel.guild).channel_removed(channel)
+
+@client.event
+async def on_guild_channel_update(before, after):
+    handles.get(after.guild).channel_removed(before)
+    handles.get(after.guild).channel_added(after)
+
+@client.event
+async def on_guild_role_create(role):
+    handles.get(role.guild).role_added(role)
+
+
+@client.event
+async def on_member_update(before, after):
+    game_status.get(after.guild).update_member(after)
+
+@client.event
+async def on_member_join(member):
+    game_status.get(member.guild).update_member(member)
+
+@client.event
+async def on_raw_member_remove(payload):
+    # the raw event, because the members aren't in the cache of discord.py
+    guild = client.get_guild(payload.guild_id)
+    if guild is not None:
+        game_status.get(guild).remove_member(payload.user.id)
+
+@client.event
+async def on_guild_role_update(before, after):
+    handles.get(after.guild).role_removed(before)
+    handles.get(after.guild).role_added(after)
+    # renaming a game role or changing the admin permission can change everything, so then go through the members again (a colour or position doesn't matter)
+    if (GuildStatus.role_matters(before) or GuildStatus.role_matters(after)) and (before.name != after.name or before.permissions.administrator != after.permissions.administrator):
+        game_status.get(after.guild).rebuild()
+
+@client.event
+async def on_guild_role_delete(role):
+    handles.get(role.guild).role_removed(role)
+    if GuildStatus.role_matters(role):
+        game_status.get(role.guild).rebuild()
+
 class Checks:
     """Checking decorators for the commands. Class based for easy use."""
     def admin_only(func):
         """Check if user has admin permissions"""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
             if not interaction.user.guild_permissions.administrator:
-                await interaction.followup.send(f"You don't have permission to use this command, {interaction.user.mention}")
+                await outbox.followup(interaction, f"You don't have permission to use this command, {interaction.user.mention}")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
@@ -137,8 +491,8 @@ class Checks:
     def main_channel_only(func):
         """Check if the command is used in the main channel"""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            if not interaction.channel.name == "main":
-                await interaction.followup.send(f"You can't use this command here, {interaction.user.mention}")
+            if not interaction.channel == handles.get(interaction.guild).main:
+                await outbox.followup(interaction, f"You can't use this command here, {interaction.user.mention}")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
@@ -146,8 +500,8 @@ class Checks:
     def runners_channel_only(func):
         """Check if the command is used in the runners-only channel"""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            if not interaction.channel.name == "runners-only":
-                await interaction.followup.send(f"You can't use this command here, {interaction.user.mention}")
+            if not interaction.channel == handles.get(interaction.guild).runners_channel:
+                await outbox.followup(interaction, f"You can't use this command here, {interaction.user.mention}")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
@@ -155,8 +509,8 @@ class Checks:
     def enough_players(func):
         """Check if there are enough players to start the game"""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            if len([member for member in interaction.guild.members if not member.bot and not member.guild_permissions.administrator]) != 3:
-                await interaction.followup.send(f"Not the right amount of players to start the game. There need to be exactly 3 players, excluding bots and admins.")
+            if len((await game_status.loaded(interaction.guild)).eligible) != 3:
+                await outbox.followup(interaction, f"Not the right amount of players to start the game. There need to be exactly 3 players, excluding bots and admins.")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
@@ -164,8 +518,8 @@ class Checks:
     def isnt_running(func):
         """Makes sure the game isn't running"""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            if any([any(role.name in ["Runner", "Chaser"] for role in member.roles) for member in interaction.guild.members]):
-                await interaction.followup.send(f"A game is already running. Please stop the game before running this command.")
+            if (await game_status.loaded(interaction.guild)).running():
+                await outbox.followup(interaction, f"A game is already running. Please stop the game before running this command.")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
@@ -173,8 +527,8 @@ class Checks:
     def is_running(func):
         """Makes sure the game is running"""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            if not any([any(role.name in ["Runner", "Chaser"] for role in member.roles) for member in interaction.guild.members]):
-                await interaction.followup.send(f"No game is currently running, go start one first.")
+            if not (await game_status.loaded(interaction.guild)).running():
+                await outbox.followup(interaction, f"No game is currently running, go start one first.")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
@@ -182,8 +536,8 @@ class Checks:
     def players_exist(func):
         """Check if players exist. This happens if the program restarts in the middle of a game."""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            if not 'players' in globals() and not 'players' in locals():
-                await interaction.followup.send(f"No players are currently in the game. The program may have restarted.")
+            if games.get(interaction.guild).players is None:
+                await outbox.followup(interaction, f"No players are currently in the game. The program may have restarted.")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
@@ -191,8 +545,8 @@ class Checks:
     def no_card_active(func):
         """Checks that no card is active"""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            if Card_IsActive:
-                await interaction.followup.send(f"A card is currently active. Please finish that one before drawing a new one.")
+            if games.get(interaction.guild).card_active:
+                await outbox.followup(interaction, f"A card is currently active. Please finish that one before drawing a new one.")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
@@ -200,64 +554,150 @@ class Checks:
     def card_active(func):
         """Checks that a card is active"""
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            if not Card_IsActive:
-                await interaction.followup.send(f"No card is currently active. Please draw a card first.")
+            if not games.get(interaction.guild).card_active:
+                await outbox.followup(interaction, f"No card is currently active. Please draw a card first.")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
     
     def no_veto_active(func):
         """Checks that no veto is active"""
-        global Veto_IsActive, Veto_EndTime
         async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-            global Veto_IsActive, Veto_EndTime
-            if int(time.time()) < Veto_EndTime:
-                await interaction.followup.send(f"A veto is currently active. Please wait for it to finish before drawing a new card.")
+            if games.get(interaction.guild).vetoed(time.time()):
+                await outbox.followup(interaction, f"A veto is currently active. Please wait for it to finish before drawing a new card.")
                 return
             await func(interaction, *args, **kwargs)
         return wrapper
 
+class PromptRegistry:
+    """The buttons of the confirm prompts and the shop. Instead of a View with callbacks for every message (which discord.py keeps forever without a timeout),
+    the buttons only have a custom_id: jetlag:<kind>:<nonce>:<user id>:<choice>, and on_interaction gives a press to the handler of that kind.
+    The nonce is the id of the interaction that made the prompt, so its age is known even after a restart. Prompts older than max_age have expired.
+    Only the confirm prompts keep something (what to run when confirmed), at most max_prompts of them, the oldest is dropped first."""
+    PREFIX = "jetlag"
+
+    def __init__(self, max_age=15 * 60, max_prompts=500):
+        self.max_age = max_age
+        self.max_prompts = max_prompts
+        self.handlers = {}
+        self.pending = OrderedDict()
+        self.expired = 0
+
+    def handler(self, kind):
+        """Decorator for the function that handles the buttons of a kind: handler(interaction, nonce, user_id, choice)"""
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def view(self, kind, nonce, user_id, buttons):
+        """A view with buttons (choice, label, style). It is stopped right away, so discord.py doesn't keep it (the presses go through dispatch)."""
+        view = discord.ui.View(timeout=None)
+        for choice, label, style in buttons:
+            view.add_item(discord.ui.Button(label=label, style=style, custom_id=f"{PromptRegistry.PREFIX}:{kind}:{nonce}:{user_id}:{choice}"))
+        view.stop()
+        return view
+
+    def age(self, nonce):
+        return time.time() - discord.utils.snowflake_time(nonce).timestamp()
+
+    def keep(self, nonce, data):
+        """Keep something for a prompt until it's answered (or expires)"""
+        self.pending[nonce] = data
+        while len(self.pending) > self.max_prompts:
+            self.pending.popitem(last=False)
+            self.expired += 1
+        # the oldest are first, drop the expired ones
+        while self.pending and self.age(next(iter(self.pending))) > self.max_age:
+            self.pending.popitem(last=False)
+            self.expired += 1
+
+    def take(self, nonce):
+        """What was kept for a prompt (it's removed), or None if it expired"""
+        data = self.pending.pop(nonce, None)
+        if data is not None and self.age(nonce) > self.max_age:
+            self.expired += 1
+            return None
+        return data
+
+    async def dispatch(self, interaction):
+        """Give a button press to its handler. Returns False if it isn't a button of the bot."""
+        parts = (interaction.data or {}).get("custom_id", "").split(":")
+        if len(parts) != 5 or parts[0] != PromptRegistry.PREFIX or parts[1] not in self.handlers:
+            return False
+        kind, nonce, user_id, choice = parts[1], int(parts[2]), int(parts[3]), parts[4]
+        if self.age(nonce) > self.max_age:
+            self.pending.pop(nonce, None)
+            await interaction.response.edit_message(content="This has expired, please use the command again.", view=None)
+            return True
+        metrics.begin(kind)
+        try:
+            await self.handlers[kind](interaction, nonce, user_id, choice)
+        finally:
+            metrics.finish()
+        return True
+
+prompts = PromptRegistry()
+
+def timed_check(name, check):
+    """Time a check, up to where it lets the command through"""
+    def decorator(func):
+        async def passed(interaction: discord.Interaction, *args, **kwargs):
+            metrics.lap(f"check {name}")
+            await func(interaction, *args, **kwargs)
+        return check(passed)
+    return decorator
+
+for check_name in ["admin_only", "main_channel_only", "runners_channel_only", "enough_players", "isnt_running", "is_running", "players_exist", "no_card_active", "card_active", "no_veto_active"]:
+    setattr(Checks, check_name, timed_check(check_name, getattr(Checks, check_name)))
+
 def confirm(func):
     """Roughly based uppon the reaction from "Just a random coder" on:
     https://stackoverflow.com/questions/76299397/how-to-add-accept-deny-button-to-a-submission-bot-discord-py/76302606#76302606"
     
     This decorator adds a confirm and cancel button to the command, and only runs the command if the confirm button is pressed by the same user who used the command.
-    Made for safety."""
+    Made for safety. The buttons are handled by confirm_button (through the prompt registry)."""
     async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-        
-        iu = interaction.user
-        b1 = discord.ui.Button(label='Confirm', style=discord.ButtonStyle.success)
-        b2 = discord.ui.Button(label='Cancel', style=discord.ButtonStyle.danger)
-        view = discord.ui.View()
-        view.add_item(b1)
-        view.add_item(b2)
-        async def b1_callback(interaction:discord.Interaction):
-            if interaction.user != iu:
-                await interaction.response.send_message(f"{interaction.user.mention}You can't confirm this command, as it was run by {iu.mention}.", ephemeral=True)
-                return
-            await prevmessage.edit(content="Confirmed", view=None)
-            await func(interaction, *args, **kwargs)
-        async def b2_callback(interaction:discord.Interaction):
-            if interaction.user != iu:
-                await interaction.response.send_message(f"{interaction.user.mention}You can't cancel this command, as it was run by {iu.mention}.", ephemeral=True)
-                return
-            await prevmessage.edit(content="Cancelled", view=None)
-        b1.callback = b1_callback
-        b2.callback = b2_callback
+        # the name of the command is kept too, the function is the run() inside a defer, so its own name says nothing
+        prompts.keep(interaction.id, (interaction.command.name, func, args, kwargs))
+        view = prompts.view("confirm", interaction.id, interaction.user.id, [("yes", 'Confirm', discord.ButtonStyle.success), ("no", 'Cancel', discord.ButtonStyle.danger)])
         # sadly, this can NOT be set to only visible for the user who used the command (due to deferring), so we have to check if the user is the same as the user who used the command.
-        prevmessage = await interaction.followup.send('Are you sure?', ephemeral=True, view=view)
+        await outbox.followup(interaction, 'Are you sure?', ephemeral=True, view=view)
            
     return wrapper
 
+@prompts.handler("confirm")
+async def confirm_button(interaction: discord.Interaction, nonce, user_id, choice):
+    if interaction.user.id != user_id:
+        await interaction.response.send_message(f"{interaction.user.mention}You can't {'confirm' if choice == 'yes' else 'cancel'} this command, as it was run by <@{user_id}>.", ephemeral=True)
+        return
+    pending = prompts.take(nonce)
+    if pending is None:
+        await interaction.response.edit_message(content="This has expired, please use the command again.", view=None)
+        return
+    if choice != "yes":
+        await interaction.response.edit_message(content="Cancelled", view=None)
+        return
+    command, func, args, kwargs = pending
+    # the rest of the command is timed as that command
+    metrics.current.get().command = command
+    await interaction.response.edit_message(content="Confirmed", view=None)
+    await func(interaction, *args, **kwargs)
+
+chatlogs = ChatlogRegistry()
+
+archiver = AttachmentArchiver()
+
 @client.event
 async def on_message(message):
-    """Save the chatlog to a file, and the attachments to a folder. This is done for all messages in all channels."""
+    """Save the chatlog, and the attachments to a folder. This is done for all messages in all channels."""
+    metrics.count("jetlag_messages_total")
     try:
-        with open(f"chatlog/{message.channel.name}.txt", "a") as file:
-            file.write(f"{message.author.name}: {message.content}\n")
-        if len(message.attachments) > 0:
-            for attachment in message.attachments:
-                await attachment.save(f"chatlog/{message.channel.name}/{attachment.filename}")
+        if CONFIG["chatlog"]:
+            chatlogs.get(message.guild).write(message.channel.name, {"ts": message.created_at.timestamp(), "id": message.id, "author": message.author.name, "author_id": message.author.id, "content": message.content})
+        if CONFIG["attachments"] and len(message.attachments) > 0:
+            with metrics.timer("jetlag_attachment_seconds"):
+                await archiver.save_all(message.attachments, message.guild, message.channel.name, message.id)
     except (AttributeError, FileNotFoundError):
         pass
 
@@ -269,12 +709,14 @@ async def help(interaction: discord.Interaction):
     """The full help menu"""
     @defer
     async def run(interaction: discord.Interaction):
-        await interaction.followup.send( \
+        await outbox.followup(interaction,  \
 """The Help Menu:
 
 - Usable Everywhere:
-    - /winner place:
-    shows the winner at the given place or coordinates
+    - /winner place (show_map):
+    shows the winner at the given place or coordinates (and on the map)
+    - /winners places:
+    shows the winners at multiple places, separated by ;
     - /help:
     shows this help menu
     - /wallet:
@@ -301,6 +743,12 @@ async def help(interaction: discord.Interaction):
     Switch the runners and chasers around, and give 300 coins to the new runner.
     - /manual user(tag) role(tag) coins
     Only if neccesary, manually fix roles and coins
+    - /search (text) (channel) (author) (hours):
+    Search the chatlog of the current game (only visible to you)
+    - /stats:
+    Shows how fast the bot is (only visible to you)
+    - /profile seconds:
+    Profile the bot for some seconds, and save the profile (only visible to you)
 """
 )
     await run(interaction)
@@ -320,13 +768,105 @@ async def clear(interaction: discord.Interaction):
         await interaction.channel.purge()
     await run(interaction)
         
+@client.tree.command(
+    name="search",
+    description="Search the chatlog of the current game"
+)
+async def search(interaction: discord.Interaction, text: Optional[str], channel: Optional[str], author: Optional[discord.Member], hours: Optional[int]):
+    """Search the chatlog (only visible to the admin who used it). Everything is optional, without anything it shows the last messages."""
+    @defer
+    @Checks.admin_only
+    async def run(interaction: discord.Interaction, text: Optional[str], channel: Optional[str], author: Optional[discord.Member], hours: Optional[int]):
+        since = time.time() - hours * 60 * 60 if hours is not None else None
+        results = await chatlogs.get(interaction.guild).search(channel=channel, author_id=author.id if author is not None else None, since=since, text=text)
+        if len(results) == 0:
+            await outbox.followup(interaction, "Nothing found.", ephemeral=True)
+            return
+        msg = ""
+        for result_channel, message in results:
+            line = f"[{result_channel}] <t:{int(message['ts'])}:t> {message['author']}: {message['content']}\n"
+            # discord messages can't be longer than 2000 characters
+            if len(msg) + len(line) > 1900:
+                msg += "..."
+                break
+            msg += line
+        await outbox.followup(interaction, msg, ephemeral=True)
+    await run(interaction, text, channel, author, hours)
+
+metrics.gauge("jetlag_games_running", lambda: sum(game.players is not None for game in games.guilds.values()))
+metrics.gauge("jetlag_chatlog_queue_depth", lambda: sum(writer.depth() for writer in chatlogs.guilds.values()))
+metrics.gauge("jetlag_outbox_targets", lambda: len(outbox.targets))
+metrics.gauge("jetlag_outbox_sent_total", lambda: outbox.sent)
+metrics.gauge("jetlag_prompts_pending", lambda: len(prompts.pending))
+metrics.gauge("jetlag_prompts_expired_total", lambda: prompts.expired)
+metrics.gauge("jetlag_render_queue_depth", lambda: render_queue.pending())
+metrics.gauge("jetlag_nominatim_requests_total", lambda: geocoder.requests)
+metrics.gauge("jetlag_geocache_hits_total", lambda: geocache.hits)
+metrics.gauge("jetlag_tile_cache_hits_total", lambda: tile_cache.hits)
+metrics.gauge("jetlag_tile_cache_misses_total", lambda: tile_cache.misses)
+if resource is not None:
+    metrics.gauge("jetlag_max_rss_megabytes", memory_mb)
+
+@client.tree.command(
+    name="stats",
+    description="Shows how fast the bot is"
+)
+async def stats(interaction: discord.Interaction):
+    """The timings of the commands, the event loop lag and the requests to discord (only visible to the admin who used it). Everything is also on the metrics endpoint."""
+    @defer
+    @Checks.admin_only
+    async def run(interaction: discord.Interaction):
+        histograms, counters = metrics.snapshot()
+        msg = "Commands (count, median, 95%, max):\n"
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name == "jetlag_command_seconds":
+                msg += f"    /{dict(labels)['command']}: {histogram.count}, {histogram.quantile(0.5):.2f}s, {histogram.quantile(0.95):.2f}s, {histogram.max:.2f}s\n"
+        msg += "Slowest parts (95%):\n"
+        parts = [(histogram.quantile(0.95), dict(labels)) for (name, labels), histogram in histograms.items() if name in ("jetlag_stage_seconds", "jetlag_call_seconds")]
+        for seconds, labels in sorted(parts, key=lambda part: part[0], reverse=True)[:8]:
+            msg += f"    /{labels['command']} {labels.get('stage') or labels.get('call')}: {seconds:.2f}s\n"
+        lag = histograms.get(("jetlag_event_loop_lag_seconds", ()))
+        if lag is not None:
+            msg += f"Event loop lag: 95% {lag.quantile(0.95) * 1000:.0f}ms, max {lag.max * 1000:.0f}ms\n"
+        requests_total = sum(value for (name, labels), value in counters.items() if name == "jetlag_discord_requests_total")
+        rate_limited = sum(value for (name, labels), value in counters.items() if name == "jetlag_discord_429_total")
+        msg += f"Discord requests: {requests_total}, rate limited: {rate_limited}, messages sent: {outbox.sent} ({outbox.merged} merged)\n"
+        msg += f"Messages seen: {metrics.counter('jetlag_messages_total')}, chatlog queue: {sum(writer.depth() for writer in chatlogs.guilds.values())}\n"
+        msg += f"Geocoding requests: {geocoder.requests}, tiles: {tile_cache.hits} cached / {tile_cache.misses} downloaded"
+        await outbox.followup(interaction, msg[:1990], ephemeral=True)
+    await run(interaction)
+
+@client.tree.command(
+    name="profile",
+    description="Profile the bot for some seconds"
+)
+async def profile(interaction: discord.Interaction, seconds: int):
+    """Make a profile while the bot is running (for when it's slow mid-game), only visible to the admin who used it"""
+    @defer
+    @Checks.admin_only
+    async def run(interaction: discord.Interaction, seconds: int):
+        if seconds < 1 or seconds > 300:
+            await outbox.followup(interaction, "Please profile for 1 to 300 seconds.", ephemeral=True)
+            return
+        if profiler.running:
+            await outbox.followup(interaction, "A profile is already being made, wait for that one to finish.", ephemeral=True)
+            return
+        # taken before the first await, otherwise two /profile at the same time both get past the check
+        profiler.running = True
+        try:
+            await outbox.followup(interaction, f"Profiling for {seconds} seconds...", ephemeral=True)
+            summary = await profiler.run(seconds)
+        finally:
+            profiler.running = False
+        await outbox.followup(interaction, summary[:1990], ephemeral=True)
+    await run(interaction, seconds)
+
 @client.tree.command(
     name="start",
     description="Starts the game"
 )
 async def start(interaction: discord.Interaction, start: str, end1: str, end2: str, end3: str):
     """Start the game with the given positions. The bot will randomly assign roles and end locations to the players. The bot will also create the runners-only and chasers-only channels."""
-    global players
     @defer
     @Checks.admin_only
     @Checks.main_channel_only
@@ -335,61 +875,62 @@ async def start(interaction: discord.Interaction, start: str, end1: str, end2: s
     @confirm
     @defer
     async def run(interaction: discord.Interaction, start: str, end1: str, end2: str, end3: str):
-        global players
-        try:
-            shutil.rmtree('chatlog')
-        except FileNotFoundError:
-            pass
-        os.mkdir('chatlog')
-        os.mkdir('chatlog/main')
-        os.mkdir('chatlog/chasers-only')
-        os.mkdir('chatlog/runners-only')
-        await interaction.followup.send(f"Chatlog Reset!\n\nGame started with the following settings:\nStart: {start}\nEnd 1: {end1}\nEnd 2: {end2}\nEnd 3: {end3}\n\nPlease wait for about 30 seconds for the map to be generated.")
+        game = games.get(interaction.guild)
+        # the chatlog of the last game is archived, not deleted
+        await chatlogs.get(interaction.guild).rotate()
+        await outbox.followup(interaction, f"Chatlog Reset!\n\nGame started with the following settings:\nStart: {start}\nEnd 1: {end1}\nEnd 2: {end2}\nEnd 3: {end3}\n\nThe map is being generated, this can take about 30 seconds.")
         try:
-            points = [get_coords(city) for city in [start, end1, end2, end3]]
+            points = await geocoder.lookup_many([start, end1, end2, end3])
         except AttributeError:
-            await interaction.followup.send("One or more of the places you entered was not found. Please try again.")
+            await outbox.followup(interaction, "One or more of the places you entered was not found. Please try again.")
             return
-        image = download_map_with_points(points)
-        
-        #send the image in the chat
-        image_bytes = BytesIO()
-        image.save(image_bytes, format="PNG")
-        image_bytes.seek(0)
-        await interaction.followup.send(file=discord.File(image_bytes, filename="Your_Map.png"))
-        destinations = [end1, end2, end3]
-        random.shuffle(destinations)
-        p = [member for member in interaction.guild.members if not member.bot and not member.guild_permissions.administrator]
-        random.shuffle(p)
+        tile_cache.prefetch_points(points)
+        try:
+            game.game_map, image_png = await render_queue.submit(render_map_png, points)
+        except asyncio.TimeoutError:
+            game.game_map = None
+            await outbox.followup(interaction, "The map took too long to generate, the game will start without it.")
+        except Exception as e:
+            # like the tile server being down, the game shouldn't fail because of the map
+            print(f"Could not make the map: {e!r}")
+            game.game_map = None
+            await outbox.followup(interaction, "The map could not be generated, the game will start without it.")
+        else:
+            #send the image in the chat
+            await outbox.followup(interaction, file=discord.File(BytesIO(image_png), filename="Your_Map.png"))
+        coords = dict(zip([end1, end2, end3], points[1:]))
         # set the players to their respective roles and destinations
-        players = [[p[0], destinations[0], "Runner", 2000], [p[1], destinations[1], "Chaser", 2000], [p[2], destinations[2], "Chaser", 2000]]
+        game.start((await game_status.loaded(interaction.guild)).eligible_members(), [end1, end2, end3], random)
+        game.destination_index = DestinationIndex([coords[destination] for player, destination, role, coins in game.players])
+        game.wallet.reset(game.players)
+        game.record("start", players=[[player.id, destination, role, coins] for player, destination, role, coins in game.players], coords=game.destination_index.coords)
+        guild_handles = handles.get(interaction.guild)
         msg = ""
-        for player, destination, role, coins in players:
-            await player.add_roles(discord.utils.get(interaction.guild.roles, name=role)) 
-            msg += (f"{player.mention} is a {discord.utils.get(interaction.guild.roles, name=role).mention} and is going to {destination.title()}.\n\n")
-        await interaction.followup.send(msg + "The game has started!, everyone gets 2000 coins!. Good luck!")
+        await set_game_roles(interaction.guild, [(player, guild_handles.role(role)) for player, destination, role, coins in game.players])
+        for player, destination, role, coins in game.players:
+            msg += (f"{player.mention} is a {guild_handles.role(role).mention} and is going to {destination.title()}.\n\n")
+        await outbox.followup(interaction, msg + f"The game has started!, everyone gets {game_core.START_COINS} coins!. Good luck!")
     
         # make a private channel named "runners-only" and make it only available to the runners
         overwrites = {
             interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False),
             interaction.guild.me: discord.PermissionOverwrite(read_messages=True),
-            discord.utils.get(interaction.guild.roles, name="Runner"): discord.PermissionOverwrite(read_messages=True),
+            guild_handles.runner_role: discord.PermissionOverwrite(read_messages=True),
         }
-        await interaction.guild.create_text_channel('runners-only', overwrites=overwrites)
+        runners_channel = await interaction.guild.create_text_channel('runners-only', overwrites=overwrites)
+        guild_handles.channel_added(runners_channel)
 
         # make a private channel named "chasers-only" and make it only available to the chasers
         overwrites = {
             interaction.guild.default_role: discord.PermissionOverwrite(read_messages=False),
             interaction.guild.me: discord.PermissionOverwrite(read_messages=True),
-            discord.utils.get(interaction.guild.roles, name="Chaser"): discord.PermissionOverwrite(read_messages=True),
+            guild_handles.chaser_role: discord.PermissionOverwrite(read_messages=True),
         }
-        await interaction.guild.create_text_channel('chasers-only', overwrites=overwrites)
-        # get the channel named runners-only and chasers-only
-        runners_channel = discord.utils.get(interaction.guild.text_channels, name="runners-only")
-        chasers_channel = discord.utils.get(interaction.guild.text_channels, name="chasers-only")
+        chasers_channel = await interaction.guild.create_text_channel('chasers-only', overwrites=overwrites)
+        guild_handles.channel_added(chasers_channel)
         # send the destinations, roles and names in the channels
-        await runners_channel.send(f"You are a {discord.utils.get(interaction.guild.roles, name='Runner').mention}, Good luck!")
-        await chasers_channel.send(f"You are a {discord.utils.get(interaction.guild.roles, name='Chaser').mention}, Good luck!")
+        await outbox.channel(runners_channel, f"You are a {guild_handles.runner_role.mention}, Good luck!")
+        await outbox.channel(chasers_channel, f"You are a {guild_handles.chaser_role.mention}, Good luck!")
         
     await run(interaction, start, end1, end2, end3)
 
@@ -397,30 +938,64 @@ async def start(interaction: discord.Interaction, start: str, end1: str, end2: s
     name="winner",
     description="Shows the winner at the given place or coordinates"
 )
-async def winner(interaction: discord.Interaction, place: str):
-    """Returns who the winner would be at the given location"""
-    global players
+async def winner(interaction: discord.Interaction, place: str, show_map: bool = False):
+    """Returns who the winner would be at the given location (and optionally shows it on the map of the game)"""
     @defer
     @Checks.is_running
     @Checks.players_exist
-    async def run(interaction: discord.Interaction, place: str):
-        global players
+    async def run(interaction: discord.Interaction, place: str, show_map: bool):
+        game = games.get(interaction.guild)
         try:
-            coords = get_coords(place)
+            coords = await get_coords(place)
         except AttributeError:
-            await interaction.followup.send("The place you entered was not found. Please try again.")
+            await outbox.followup(interaction, "The place you entered was not found. Please try again.")
             return
-        # get the coords for all the players' destinations
-        destinations = [get_coords(player[1]) for player in players]
-        # get the distance from the place to all the players' destinations
-        distances = [geodesic((coords['lat'], coords['lon']), (destination['lat'], destination['lon'])).meters for destination in destinations]
-        # get the index of the minimum distance
-        winner = distances.index(min(distances))
-        # get the winner
-        winner = players[winner][0]
-        await interaction.followup.send(f"The winner at {place.title()} would be {winner.mention}!")
+        # the destinations were already resolved at the start
+        winner = game.players[(await game.get_destination_index()).nearest([coords])[0]][0]
+        await outbox.followup(interaction, f"The winner at {place.title()} would be {winner.mention}!")
+        if show_map and game.game_map is not None:
+            # only the marker is new, the rest of the map is reused
+            try:
+                image_png = await render_queue.submit(game.game_map.png_with_marker, coords)
+            except Exception as e:
+                print(f"Could not make the map: {e!r}")
+                await outbox.followup(interaction, "The map could not be generated right now.")
+            else:
+                await outbox.followup(interaction, file=discord.File(BytesIO(image_png), filename="Winner_Map.png"))
         
-    await run(interaction, place)
+    await run(interaction, place, show_map)
+
+@client.tree.command(
+    name="winners",
+    description="Shows the winners at multiple places (separated by ;)"
+)
+async def winners(interaction: discord.Interaction, places: str):
+    """Like /winner, but for a list of places at once"""
+    @defer
+    @Checks.is_running
+    @Checks.players_exist
+    async def run(interaction: discord.Interaction, places: str):
+        game = games.get(interaction.guild)
+        places = [place.strip() for place in places.split(";") if place.strip()]
+        if len(places) == 0:
+            await outbox.followup(interaction, "Please enter one or more places, separated by ;")
+            return
+        coords = await geocoder.lookup_many(places, return_exceptions=True)
+        found = [(place, c) for place, c in zip(places, coords) if isinstance(c, dict)]
+        # all places in one go
+        closest = (await game.get_destination_index()).nearest([c for _, c in found])
+        lines = [f"{place.title()}: {game.players[index][0].mention}\n" for (place, _), index in zip(found, closest)]
+        lines += [f"{place.title()}: not found\n" for place, c in zip(places, coords) if not isinstance(c, dict)]
+        msg = ""
+        for line in lines:
+            # discord messages can't be longer than 2000 characters
+            if len(msg) + len(line) > 1900:
+                msg += "..."
+                break
+            msg += line
+        await outbox.followup(interaction, msg)
+        
+    await run(interaction, places)
     
 @client.tree.command(
     name="stop",
@@ -428,7 +1003,6 @@ async def winner(interaction: discord.Interaction, place: str):
 )
 async def stop(interaction: discord.Interaction):
     """Stops the game and removes the roles and channels"""
-    global players
     @defer
     @Checks.admin_only
     @Checks.main_channel_only
@@ -436,23 +1010,19 @@ async def stop(interaction: discord.Interaction):
     @confirm
     @defer
     async def run(interaction: discord.Interaction):
-        global players
+        game = games.get(interaction.guild)
         
-        if 'players' in globals() or 'players' in locals():
-            for player, destination, role, coins in players:
-                await player.remove_roles(discord.utils.get(interaction.guild.roles, name="Runner"))
-                await player.remove_roles(discord.utils.get(interaction.guild.roles, name="Chaser"))
+        if game.players is not None:
+            await set_game_roles(interaction.guild, [(player, None) for player, destination, role, coins in game.players])
         else:
-            players = [member for member in interaction.guild.members if not member.bot and not member.guild_permissions.administrator]
-            for player in players:
-                await player.remove_roles(discord.utils.get(interaction.guild.roles, name="Runner"))
-                await player.remove_roles(discord.utils.get(interaction.guild.roles, name="Chaser"))
+            await set_game_roles(interaction.guild, [(player, None) for player in (await game_status.loaded(interaction.guild)).eligible_members()])
 
         #remove the runners-only and chasers-only channels
-        await discord.utils.get(interaction.guild.text_channels, name="runners-only").delete()
-        await discord.utils.get(interaction.guild.text_channels, name="chasers-only").delete()
-        players = []
-        await interaction.followup.send("Game stopped. The roles have been revoked, the channels have been deleted and the coins have been removed.")
+        await handles.get(interaction.guild).runners_channel.delete()
+        await handles.get(interaction.guild).chasers_channel.delete()
+        game.reset()
+        game.record("stop")
+        await outbox.followup(interaction, "Game stopped. The roles have been revoked, the channels have been deleted and the coins have been removed.")
         
     await run(interaction)
     
@@ -462,25 +1032,24 @@ async def stop(interaction: discord.Interaction):
 )
 async def wallet(interaction: discord.Interaction, user: Optional[discord.Member]):
     """Shows the amount of coins a user has privately to them/ An admin can use this too, and see the wallets of others"""
-    global players
     @defer
     @Checks.is_running
     @Checks.players_exist
     async def run(interaction: discord.Interaction, user: Optional[discord.Member]):
-        global players
-        await interaction.followup.send(f"Just a sec... (you will recieve a message only visible to you shortly)", ephemeral=True)
+        game = games.get(interaction.guild)
+        await outbox.followup(interaction, f"Just a sec... (you will recieve a message only visible to you shortly)", ephemeral=True)
         # the optional user is only available to admins
         if user != None and not interaction.user.guild_permissions.administrator:
-            await interaction.followup.send(f"You can't see the amount of coins someone else has, {interaction.user.mention}. Use this without the optional part", ephemeral=True)
+            await outbox.followup(interaction, f"You can't see the amount of coins someone else has, {interaction.user.mention}. Use this without the optional part", ephemeral=True)
             return
         
         if user == None:
             user = interaction.user
-        for player in players:
-            if player[0] == user:
-                await interaction.followup.send(f"{user.mention} has {player[3]} coins.", ephemeral=True)
-                return
-        await interaction.followup.send(f"{user.mention} was not found in the players list.", ephemeral=True)
+        coins = game.wallet.balance(user)
+        if coins is None:
+            await outbox.followup(interaction, f"{user.mention} was not found in the players list.", ephemeral=True)
+            return
+        await outbox.followup(interaction, f"{user.mention} has {coins} coins.", ephemeral=True)
         
     await run(interaction, user)
 
@@ -490,26 +1059,24 @@ async def wallet(interaction: discord.Interaction, user: Optional[discord.Member
 )
 async def manual(interaction: discord.Interaction, user: discord.Member, role: discord.Role, coins: int):
     """In case of need, you may need to manually fix roles and coins. This is the command for that."""
-    global players
     @defer
     @Checks.admin_only
     @Checks.main_channel_only
     @confirm
     @defer
     async def run(interaction: discord.Interaction, user: discord.Member, role: discord.Role, coins: int):
-        global players
-        # remove all roles from the user
-        for player in players:
+        game = games.get(interaction.guild)
+        for player in game.players:
             if player[0] == user:
-                await user.remove_roles(discord.utils.get(interaction.guild.roles, name="Runner"))
-                await user.remove_roles(discord.utils.get(interaction.guild.roles, name="Chaser"))
-                # add the new role
-                await user.add_roles(role)
+                # replace the game roles with the new role
+                await set_game_roles(interaction.guild, [(user, role)])
                 # change the coins
-                player[3] = coins
-                await interaction.followup.send(f"{user.mention} has been set to {role.mention} and has {coins} coins.", ephemeral=True)
+                await game.wallet.set(user, coins)
+                player[2] = role.name
+                game.record("roles", roles={str(user.id): role.name})
+                await outbox.followup(interaction, f"{user.mention} has been set to {role.mention} and has {coins} coins.", ephemeral=True)
                 return
-        await interaction.followup.send(f"{user.mention} was not found in the players list.")
+        await outbox.followup(interaction, f"{user.mention} was not found in the players list.")
         
     await run(interaction, user, role, coins)
 
@@ -519,85 +1086,57 @@ async def manual(interaction: discord.Interaction, user: discord.Member, role: d
 )
 async def shop(interaction: discord.Interaction):
     """The shop, what else!"""
-    global players, Double_IsActive
     @defer
     @Checks.runners_channel_only
     @Checks.players_exist
     @Checks.no_veto_active
     async def run(interaction: discord.Interaction):
-        global players, Double_IsActive
-        iu = interaction.user
-        b1 = discord.ui.Button(label='[250 coins] Double value & veto penalty of next challenge', style=discord.ButtonStyle.blurple)
-        b2 = discord.ui.Button(label='[1500 coins] 10 minutes with your tracker off', style=discord.ButtonStyle.blurple)
-        b3 = discord.ui.Button(label='[1000 coins] Find out where the chasers are', style=discord.ButtonStyle.blurple)
-        b4 = discord.ui.Button(label='[2000 coins] Chasers stay still for 10 minutes', style=discord.ButtonStyle.blurple)
-        b5 = discord.ui.Button(label='Exit the shop', style=discord.ButtonStyle.danger)
-        
-        view = discord.ui.View()
-        view.add_item(b1)
-        view.add_item(b2)
-        view.add_item(b3)
-        view.add_item(b4)
-        view.add_item(b5)
-        
-        async def b1_callback(interaction:discord.Interaction):
-            global Double_IsActive
-            await prevmessage.edit(content="Bought 'Double value & veto penalty of next challenge'. It is now active", view=None)
-            Double_IsActive = True
-            for player in players:
-                if player[0] == iu:
-                    if player[3] < 250:
-                        await interaction.followup.send(f"{iu.mention}, you don't have enough coins to buy this item.")
-                        return
-                    player[3] -= 250
-                    return
-            
-        async def b2_callback(interaction:discord.Interaction):
-            await prevmessage.edit(content=f"Bought '10 minutes with your tracker off'. The Chasers have been notified\n\nTime left: <t:{int(time.time()) + 600}:R>", view=None)
-            await discord.utils.get(interaction.guild.text_channels, name="chasers-only").send(f"{iu.mention} has turned off their tracker for 10 minutes!\n\nTime left: <t:{int(time.time()) + 600}:R>")
-            for player in players:
-                if player[0] == iu:
-                    if player[3] < 1500:
-                        await interaction.followup.send(f"{iu.mention}, you don't have enough coins to buy this item.")
-                        return
-                    player[3] -= 1500
-                    return
-                
-        async def b3_callback(interaction:discord.Interaction):
-            await prevmessage.edit(content="Bought 'Find out where the chasers are'. The Chasers have been notified, and should send their location shortly.", view=None)
-            await discord.utils.get(interaction.guild.text_channels, name="chasers-only").send(f"{iu.mention} paid to know where you guys are! Let them know!")
-            for player in players:
-                if player[0] == iu:
-                    if player[3] < 1000:
-                        await interaction.followup.send(f"{iu.mention}, you don't have enough coins to buy this item.")
-                        return
-                    player[3] -= 1000
-                    return
-            
-        async def b4_callback(interaction:discord.Interaction):
-            await prevmessage.edit(content=f"Bought 'Chasers stay still for 10 minutes'. The Chasers have been notified.\n\nTime left: <t:{int(time.time()) + 600}:R>", view=None)
-            await discord.utils.get(interaction.guild.text_channels, name="chasers-only").send(f"{iu.mention} paid for you to stay still for 10 minutes! Send a picture now, and one in 10 minutes, so you dont cheat!\n\nTime left: <t:{int(time.time()) + 600}:R>")
-            for player in players:
-                if player[0] == iu:
-                    if player[3] < 2000:
-                        await interaction.followup.send(f"{iu.mention}, you don't have enough coins to buy this item.")
-                        return
-                    player[3] -= 2000
-                    return
-            
-            
-        async def b5_callback(interaction:discord.Interaction):
-            await prevmessage.edit(content="Shop closed", view=None)
-        
-        b1.callback = b1_callback
-        b2.callback = b2_callback
-        b3.callback = b3_callback
-        b4.callback = b4_callback
-        b5.callback = b5_callback
-        prevmessage = await interaction.followup.send('What item do you want to buy?', ephemeral=True, view=view)
+        view = prompts.view("shop", interaction.id, interaction.user.id, [
+            ("double", '[250 coins] Double value & veto penalty of next challenge', discord.ButtonStyle.blurple),
+            ("tracker_off", '[1500 coins] 10 minutes with your tracker off', discord.ButtonStyle.blurple),
+            ("find_chasers", '[1000 coins] Find out where the chasers are', discord.ButtonStyle.blurple),
+            ("chasers_still", '[2000 coins] Chasers stay still for 10 minutes', discord.ButtonStyle.blurple),
+            ("exit", 'Exit the shop', discord.ButtonStyle.danger),
+        ])
+        await outbox.followup(interaction, 'What item do you want to buy?', ephemeral=True, view=view)
     
     await run(interaction)
 
+@prompts.handler("shop")
+async def shop_button(interaction: discord.Interaction, shop_id, user_id, choice):
+    """A button of the shop. Everything it needs is in the button, so a shop still works after a restart (until it expires)."""
+    iu = interaction.user
+    if choice == "exit":
+        await interaction.response.edit_message(content="Shop closed", view=None)
+        return
+    game = games.get(interaction.guild)
+    # pay for the item before anything happens. One shop can only be used for one purchase (the key), even if the buttons are pressed at the same time.
+    status, coins = await game.wallet.debit(iu, game_core.SHOP_PRICES[choice], key=f"shop:{shop_id}")
+    if status == "insufficient":
+        await interaction.response.send_message(f"{iu.mention}, you don't have enough coins to buy this item.", ephemeral=True)
+        return
+    elif status == "duplicate":
+        await interaction.response.send_message(f"{iu.mention}, you already bought something in this shop, open a new one.", ephemeral=True)
+        return
+    elif status == "unknown":
+        await interaction.response.send_message(f"{iu.mention} was not found in the players list.", ephemeral=True)
+        return
+
+    chasers_channel = handles.get(interaction.guild).chasers_channel
+    if choice == "double":
+        game.buy_double()
+        game.record("double", double=True)
+        await interaction.response.edit_message(content="Bought 'Double value & veto penalty of next challenge'. It is now active", view=None)
+    elif choice == "tracker_off":
+        await interaction.response.edit_message(content=f"Bought '10 minutes with your tracker off'. The Chasers have been notified\n\nTime left: <t:{int(time.time()) + game_core.POWERUP_SECONDS}:R>", view=None)
+        await outbox.channel(chasers_channel, f"{iu.mention} has turned off their tracker for 10 minutes!\n\nTime left: <t:{int(time.time()) + game_core.POWERUP_SECONDS}:R>")
+    elif choice == "find_chasers":
+        await interaction.response.edit_message(content="Bought 'Find out where the chasers are'. The Chasers have been notified, and should send their location shortly.", view=None)
+        await outbox.channel(chasers_channel, f"{iu.mention} paid to know where you guys are! Let them know!")
+    elif choice == "chasers_still":
+        await interaction.response.edit_message(content=f"Bought 'Chasers stay still for 10 minutes'. The Chasers have been notified.\n\nTime left: <t:{int(time.time()) + game_core.POWERUP_SECONDS}:R>", view=None)
+        await outbox.channel(chasers_channel, f"{iu.mention} paid for you to stay still for 10 minutes! Send a picture now, and one in 10 minutes, so you dont cheat!\n\nTime left: <t:{int(time.time()) + game_core.POWERUP_SECONDS}:R>")
+
 @client.tree.command(
     name="travel",
     description="Travel with the given method for the given amount of minutes (price given per minute)"
@@ -609,35 +1148,22 @@ async def travel(interaction: discord.Interaction, method: Literal["[25 coins] h
     @Checks.players_exist
     @Checks.no_veto_active
     async def run(interaction: discord.Interaction, method: Literal["[25 coins] high-speed rail", "[10 coins] low-speed rail", "[5 coins] local bus/tram/metro", "[100 coins] plane", "[10 coins] ferry", "[1 coin] bike/scooter"], minutes: int):
-        global players
+        game = games.get(interaction.guild)
         if minutes <= 0:
-            await interaction.followup.send("You can't travel back in time, silly.")
+            await outbox.followup(interaction, "You can't travel back in time, silly.")
             return
-        if method == "[25 coins] high-speed rail":
-            cost = 25
-        elif method == "[10 coins] low-speed rail":
-            cost = 10
-        elif method == "[5 coins] local bus/tram/metro":
-            cost = 5
-        elif method == "[100 coins] plane":
-            cost = 100
-        elif method == "[10 coins] ferry":
-            cost = 10
-        elif method == "[1 coin] bike/scooter":
-            cost = 1
-        else:
-            await interaction.followup.send("That's not a valid method of travel.")
+        cost = game_core.travel_cost(method, minutes)
+        if cost is None:
+            await outbox.followup(interaction, "That's not a valid method of travel.")
             return
         
         # subtract the cost from the player's coins
-        for player in players:
-            if player[0] == interaction.user:
-                if player[3] < cost * minutes:
-                    await interaction.followup.send(f"{interaction.user.mention}, you don't have enough coins to travel for {minutes} minutes with {method}.")
-                    return
-                player[3] -= cost * minutes
-                await interaction.followup.send(f"{interaction.user.mention}, you can travel for {minutes} minutes with {method}. This costed you {cost * minutes} coins.")
-                return
+        status, coins = await game.wallet.debit(interaction.user, cost, key=f"travel:{interaction.id}")
+        if status == "insufficient":
+            await outbox.followup(interaction, f"{interaction.user.mention}, you don't have enough coins to travel for {minutes} minutes with {method}.")
+            return
+        if status == "ok":
+            await outbox.followup(interaction, f"{interaction.user.mention}, you can travel for {minutes} minutes with {method}. This costed you {cost} coins.")
         
             
         
@@ -650,28 +1176,21 @@ async def travel(interaction: discord.Interaction, method: Literal["[25 coins] h
 )
 async def draw(interaction: discord.Interaction):
     """Draw a card from the deck randomly."""
-    global Card_IsActive, Current_Card
     @defer
     @Checks.runners_channel_only
     @Checks.no_card_active
     @Checks.no_veto_active
     @Checks.players_exist
     async def run(interaction: discord.Interaction):
-        global Card_IsActive, Current_Card
-        cardnum = randint(1, 21)
-        # open the cards.json file and import it as a dictionary
-        with open("cards.json", "r") as file:
-            cards = json.load(file)
-        
-        # get the card from the dictionary
-        card = cards[str(cardnum)]
+        game = games.get(interaction.guild)
+        card = deck.draw(interaction.guild.id)
         # send the card in the chat
-        await interaction.followup.send(f"Card drawn: {card['Challenge']}\n\nPoints: {card['Reward']}\n\nPicture: {card['Picture']}\n\nExplanation: {card['Explanation']}\n")
-        if cardnum == 14:
-            await interaction.followup.send(f"Also, your random number is: {randint(1, 6)}")
+        await outbox.followup(interaction, card.text)
+        if card.dice is not None:
+            await outbox.followup(interaction, f"Also, your random number is: {randint(1, card.dice)}")
         # set the card as active
-        Card_IsActive = True
-        Current_Card = card
+        game.draw(card)
+        game.record("card", card_active=True, current_card=card.number)
     
     await run(interaction)
     
@@ -681,34 +1200,21 @@ async def draw(interaction: discord.Interaction):
 )
 async def finished(interaction: discord.Interaction, photo: discord.Attachment):
     """Finish the current card. Picture is required. Coins will be given (and doubled if powerup is active)"""
-    global Current_Card, Double_IsActive, Card_IsActive
     @defer
     @Checks.runners_channel_only
     @Checks.card_active
     @Checks.no_veto_active
     @Checks.players_exist
     async def run(interaction: discord.Interaction, photo: discord.Attachment):
-        global Current_Card, Double_IsActive, Card_IsActive
-        # get the card from the dictionary
-
-        await photo.save(f"chatlog/runners-only/{photo.filename}")
-        with open("cards.json", "r") as file:
-            cards = json.load(file)
-        # get the reward from the card
-        reward = int(Current_Card["Reward"])
-        if Double_IsActive:
-            reward *= 2
-            Double_IsActive = False
+        game = games.get(interaction.guild)
+        await archiver.save(photo, interaction.guild, "runners-only", interaction.id)
+        # get the reward from the card (doubled if the powerup is active)
+        reward = game.finish()
         # add the reward to the player's coins
-        for player in players:
-            if player[0] == interaction.user:
-                player[3] += reward
-                break
-            
-        Card_IsActive = False
-        Current_Card = None
+        await game.wallet.credit(interaction.user, reward, key=f"finished:{interaction.id}")
+        game.record("card", card_active=False, current_card=None, double=game.double_active)
         # send the photo in the chat
-        await interaction.followup.send(f"Photo recieved: {photo.url}. You have recieved the coins.")
+        await outbox.followup(interaction, f"Photo recieved: {photo.url}. You have recieved the coins.")
         
     
     await run(interaction, photo)
@@ -719,7 +1225,6 @@ async def finished(interaction: discord.Interaction, photo: discord.Attachment):
 )
 async def veto(interaction: discord.Interaction):
     """Veto command. Blocks purchases and new card drawing within this time. (30 minutes, or 1 hour if the double powerup is active)"""
-    global Veto_IsActive, Card_IsActive, Double_IsActive, Veto_EndTime
     @defer
     @Checks.runners_channel_only
     @Checks.card_active
@@ -728,17 +1233,11 @@ async def veto(interaction: discord.Interaction):
     @confirm
     @defer
     async def run(interaction: discord.Interaction):
-        global Veto_IsActive, Card_IsActive, Double_IsActive, Veto_EndTime
-
-        if Double_IsActive:
-            Veto_EndTime = int(time.time()) + 30*60*2
-        else:
-            Veto_EndTime = int(time.time()) + 30*60
-        await interaction.followup.send(f"Veto activated. No new cards can be drawn or purchases can be made until <t:{Veto_EndTime}:R>.")
+        game = games.get(interaction.guild)
 
-        Card_IsActive = False
-        Veto_IsActive = True
-        Double_IsActive = False
+        game.veto(time.time())
+        await outbox.followup(interaction, f"Veto activated. No new cards can be drawn or purchases can be made until <t:{game.veto_end_time}:R>.")
+        game.record("veto", veto_end=game.veto_end_time, card_active=False, double=False)
         
     await run(interaction)
 
@@ -748,7 +1247,6 @@ async def veto(interaction: discord.Interaction):
 )
 async def tagged(interaction: discord.Interaction):
     """Switch the runners and chasers around, and give 300 coins to the new runner. (if a full round has been done)"""
-    global players, Double_IsActive, Card_IsActive, Veto_IsActive, Current_Card, Veto_EndTime, FullRoundDone
     @defer
     @Checks.admin_only
     @Checks.main_channel_only
@@ -756,55 +1254,36 @@ async def tagged(interaction: discord.Interaction):
     @confirm
     @defer
     async def run(interaction: discord.Interaction):
-        global players, Double_IsActive, Card_IsActive, Veto_IsActive, Current_Card, Veto_EndTime, FullRoundDone
+        game = games.get(interaction.guild)
         #purge the runners and chasers' channels
         try:
-            await discord.utils.get(interaction.guild.text_channels, name="runners-only").purge()
-            await discord.utils.get(interaction.guild.text_channels, name="chasers-only").purge()
+            await handles.get(interaction.guild).runners_channel.purge()
+            await handles.get(interaction.guild).chasers_channel.purge()
         except AttributeError:
             pass
             
-        Double_IsActive = False
-        Card_IsActive = False
-        Veto_IsActive = False
-        Current_Card = None
-        Veto_EndTime = 0
-            
-        if players[0][2] == "Runner":
-            players[0][2] = "Chaser"
-            players[1][2] = "Runner"
-            if FullRoundDone:
-                players[1][3] += 300
-        elif players[1][2] == "Runner":
-            players[1][2] = "Chaser"
-            players[2][2] = "Runner"
-            if FullRoundDone:
-                players[2][3] += 300
-        elif players[2][2] == "Runner":
-            players[2][2] = "Chaser"
-            players[0][2] = "Runner"
-            if FullRoundDone:
-                players[0][3] += 300
-            else:
-                FullRoundDone = True
+        bonus_player = game.tagged()
+        game.record("tagged", card_active=False, current_card=None, double=False, veto_end=0, full_round=game.full_round_done)
+        game.record("roles", roles={str(player[0].id): player[2] for player in game.players})
+        if bonus_player is not None:
+            await game.wallet.credit(bonus_player[0], game_core.TAGGED_BONUS, key=f"tagged:{interaction.id}")
         
-        # remove all roles from the players
-        for player in players:
-            await player[0].remove_roles(discord.utils.get(interaction.guild.roles, name="Runner"))
-            await player[0].remove_roles(discord.utils.get(interaction.guild.roles, name="Chaser"))
+        # switch the roles of all players at once
+        guild_handles = handles.get(interaction.guild)
+        await set_game_roles(interaction.guild, [(player, guild_handles.role(role)) for player, destination, role, coins in game.players])
         
         msg = ""
-        for player, destination, role, coins in players:
-            await player.add_roles(discord.utils.get(interaction.guild.roles, name=role))
-            msg += (f"{player.mention} is now a {discord.utils.get(interaction.guild.roles, name=role).mention} and (dont forget) they are going to {destination.title()}.\n\n")
+        for player, destination, role, coins in game.players:
+            msg += (f"{player.mention} is now a {guild_handles.role(role).mention} and (dont forget) they are going to {destination.title()}.\n\n")
 
-        if FullRoundDone:
-            await interaction.followup.send(msg + "Roles switched, and 300 coins given to the new runner. (a full round has been done)")
+        if game.full_round_done:
+            await outbox.followup(interaction, msg + f"Roles switched, and {game_core.TAGGED_BONUS} coins given to the new runner. (a full round has been done)")
             
         else: 
-            await interaction.followup.send(msg + "Roles switched.")
+            await outbox.followup(interaction, msg + "Roles switched.")
         
     await run(interaction)
     
 
+mark_startup("commands")
 client.run(TOKEN)
\ No newline at end of file
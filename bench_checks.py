@@ -0,0 +1,100 @@
+"""Times the checks (is a game running, are there enough players) for guilds from 10 to 100k members, with fake guilds and members instead of discord.
+The checks use GuildStatus (game_core.py), so after the members are loaded once they should take the same time for every size.
+For comparison it also times the old way, going through all members (and their roles) for every check.
+
+    python3 bench_checks.py --sizes 10 100 1000 10000 100000
+"""
+import argparse
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+from game_core import GameStatus
+
+def make_role(name, administrator=False):
+    return SimpleNamespace(name=name, permissions=SimpleNamespace(administrator=administrator))
+
+class FakeGuild:
+    """Just enough of a discord guild for GuildStatus: the members are already in the cache (chunked)"""
+    def __init__(self, guild_id, members):
+        self.id = guild_id
+        self.members = members
+        self.by_id = {member.id: member for member in members}
+        self.chunked = True
+
+    def get_member(self, member_id):
+        return self.by_id.get(member_id)
+
+    async def chunk(self):
+        self.chunked = True
+
+    async def fetch_member(self, member_id):
+        return self.by_id[member_id]
+
+def make_guild(guild_id, size, rng):
+    """A guild with size members: a few bots and admins, 3 players of which one has the Runner and two the Chaser role"""
+    everyone, admin, other = make_role("@everyone"), make_role("Admin", True), make_role("Member")
+    runner, chaser = make_role("Runner"), make_role("Chaser")
+    members = []
+    for i in range(size):
+        bot = rng.random() < 0.01
+        roles = [everyone] + ([admin] if rng.random() < 0.01 else []) + ([other] if rng.random() < 0.5 else [])
+        members.append(SimpleNamespace(id=i, bot=bot, roles=roles, guild_permissions=SimpleNamespace(administrator=admin in roles)))
+    for member, role in zip(rng.sample(members, 3), [runner, chaser, chaser]):
+        member.roles.append(role)
+    return FakeGuild(guild_id, members)
+
+def old_running(guild):
+    """How is_running checked before GuildStatus"""
+    return any([any(role.name in ["Runner", "Chaser"] for role in member.roles) for member in guild.members])
+
+def old_enough_players(guild):
+    """How enough_players checked before GuildStatus"""
+    return len([member for member in guild.members if not member.bot and not member.guild_permissions.administrator]) == 3
+
+def per_call(func, repeat):
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - begin) / repeat
+
+async def per_call_async(func, repeat):
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        await func()
+    return (time.perf_counter() - begin) / repeat
+
+async def bench(size, repeat, rng):
+    guild = make_guild(size, size, rng)
+    game_status = GameStatus()
+    begin = time.perf_counter()
+    await game_status.loaded(guild)
+    load = time.perf_counter() - begin
+
+    async def checks():
+        status = await game_status.loaded(guild)
+        return status.running(), len(status.eligible) == 3
+
+    check = await per_call_async(checks, repeat)
+    member = rng.choice(guild.members)
+    update = per_call(lambda: game_status.get(guild).update_member(member), repeat)
+    # the old checks get slow, don't run them as often for the big guilds
+    old = per_call(lambda: (old_running(guild), old_enough_players(guild)), max(1, min(repeat, 1000000 // size)))
+    return load, check, update, old
+
+async def main():
+    parser = argparse.ArgumentParser(description="Time the game checks for guilds of different sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=10000, help="checks per size")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'members':>8}  {'first load':>11}  {'check':>9}  {'member event':>12}  {'old check':>10}")
+    for size in args.sizes:
+        load, check, update, old = await bench(size, args.repeat, rng)
+        print(f"{size:>8}  {load * 1000:>9.2f}ms  {check * 1e6:>7.2f}us  {update * 1e6:>10.2f}us  {old * 1e6:>8.0f}us")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+"""Runs a lot of games in one process at the same time, with fake guilds and members instead of discord, to see what every game costs when the bot is in a lot of servers.
+Every game keeps the same parts as a Game of the bot: the members of its guild (GuildStatus), the game state and the wallet, the destinations (DestinationIndex), its map and its events in the game store.
+For every amount of games it prints the memory per game, and how long the commands take while all games play at the same time.
+
+    python3 bench_games.py --games 1 10 100 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+
+import game_core
+from bench_checks import make_guild
+from game_core import GameState, GameStatus, Wallet
+from game_store import GameStore
+from geocoding import DestinationIndex
+from maps import MAP_WIDTH, MAP_HEIGHT, GameMap, MapProjection, fit_view, lon_to_x, lat_to_y
+
+def rss_mb():
+    """The memory the process uses right now (linux only, None elsewhere)"""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def random_place(rng):
+    # somewhere in europe
+    return {'lat': rng.uniform(40, 60), 'lon': rng.uniform(-5, 25)}
+
+class BenchGame:
+    """The parts of a Game of the bot, for one fake guild"""
+    def __init__(self, guild, game_status, store, rng, with_map):
+        self.guild = guild
+        self.status = game_status.get(guild)
+        self.store = store
+        self.state = GameState()
+        self.wallet = Wallet(lambda row: store.record(guild.id, "coins", member=row[0].id, coins=row[3]))
+        self.rng = rng
+        self.with_map = with_map
+
+    async def start(self):
+        await self.status.load()
+        points = [random_place(self.rng) for _ in range(4)]
+        members = [self.guild.get_member(member_id) for member_id in sorted(self.status.eligible)[:3]]
+        self.state.start(members, ["end 1", "end 2", "end 3"], self.rng)
+        self.wallet.reset(self.state.players)
+        self.destinations = DestinationIndex(points[1:])
+        self.game_map = None
+        if self.with_map:
+            zoom, center = fit_view(points, MAP_WIDTH, MAP_HEIGHT)
+            projection = MapProjection(zoom, lon_to_x(center[0], zoom), lat_to_y(center[1], zoom), MAP_WIDTH, MAP_HEIGHT)
+            self.game_map = GameMap((zoom, center), projection, points[1:])
+        self.store.record(self.guild.id, "start", players=[[player.id, destination, role, coins] for player, destination, role, coins in self.state.players], coords=self.destinations.coords)
+
+    async def command(self, name, key):
+        """Roughly what the command does in the bot, without sending anything"""
+        runner = next(player for player in self.state.players if player[2] == "Runner")
+        if not self.status.running():
+            return
+        if name == "draw":
+            if not self.state.card_active and not self.state.vetoed(time.time()):
+                self.state.draw(SimpleNamespace(number=1, reward=100))
+                self.store.record(self.guild.id, "card", card_active=True, current_card=1)
+        elif name == "finished":
+            if self.state.card_active:
+                await self.wallet.credit(runner[0], self.state.finish(), key=f"finished:{key}")
+        elif name == "travel":
+            await self.wallet.debit(runner[0], game_core.travel_cost("[5 coins] local bus/tram/metro", 10), key=f"travel:{key}")
+        elif name == "shop":
+            await self.wallet.debit(runner[0], game_core.SHOP_PRICES["double"], key=f"shop:{key}")
+        elif name == "winner":
+            self.destinations.nearest([random_place(self.rng)])
+        elif name == "tagged":
+            bonus = self.state.tagged()
+            if bonus is not None:
+                await self.wallet.credit(bonus[0], game_core.TAGGED_BONUS)
+            self.store.record(self.guild.id, "roles", roles={str(player[0].id): player[2] for player in self.state.players})
+
+async def play(game, commands, latencies, rng):
+    for i in range(commands):
+        name = rng.choices(["draw", "finished", "travel", "shop", "winner", "tagged"], weights=[4, 4, 6, 2, 4, 1])[0]
+        begin = time.perf_counter()
+        await game.command(name, f"{game.guild.id}:{i}")
+        latencies.append(time.perf_counter() - begin)
+        # the players don't all press at the same moment
+        await asyncio.sleep(rng.random() / 1000)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run a lot of games at once to measure the memory per game and the time of the commands")
+    parser.add_argument("--games", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--members", type=int, default=50, help="members per guild")
+    parser.add_argument("--commands", type=int, default=50, help="commands per game")
+    parser.add_argument("--no-map", action="store_true", help="without the map")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp()
+    store = GameStore(os.path.join(directory, "gamestate.db"))
+    game_status = GameStatus()
+    games = []
+    # import numpy (and let it set up) first, so that isn't counted as the memory of the first game
+    DestinationIndex([random_place(rng)]).nearest([random_place(rng)])
+    before = rss_mb()
+    print(f"{'games':>6}  {'memory':>9}  {'per game':>9}  {'commands':>9}  {'p50':>8}  {'p99':>8}  {'max':>8}")
+    for amount in sorted(args.games):
+        while len(games) < amount:
+            game = BenchGame(make_guild(len(games), args.members, rng), game_status, store, rng, not args.no_map)
+            await game.start()
+            games.append(game)
+        memory = rss_mb()
+        latencies = []
+        await asyncio.gather(*[play(game, args.commands, latencies, rng) for game in games])
+        await store.flush()
+        per_game = f"{(memory - before) / amount:>7.2f}MB" if memory is not None else "?"
+        total = f"{memory:>7.0f}MB" if memory is not None else "?"
+        print(f"{amount:>6}  {total:>9}  {per_game:>9}  {len(latencies):>9}  {percentile(latencies, 0.5) * 1e6:>6.0f}us  {percentile(latencies, 0.99) * 1e6:>6.0f}us  {max(latencies) * 1e6:>6.0f}us")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,183 @@
+"""Compares the startup of the bot with and without cache_all_members, with fake guilds instead of discord: the time until on_ready and the peak memory.
+With cache_all_members (the old way) every guild is chunked before on_ready: discord sends all members, 1000 per chunk, and discord.py makes a member (and a user) for each of them.
+Without it (the default) nothing is chunked at startup, only the guilds that play a game are chunked, the first time a game check needs them (GuildStatus in game_core.py).
+Every setting runs in its own process, because the peak memory (ru_maxrss) can't be reset.
+
+    python3 bench_ready.py --sizes 100000 20000 5000 --small 500 --playing 10
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+from array import array
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from game_core import GameStatus
+
+CHUNK_SIZE = 1000
+
+def peak_mb():
+    """The peak resident memory of this process in MB (None on windows)"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class FakeRole:
+    __slots__ = ("id", "name", "administrator")
+
+    def __init__(self, role_id, name, administrator=False):
+        self.id = role_id
+        self.name = name
+        self.administrator = administrator
+
+    @property
+    def permissions(self):
+        return self
+
+class FakeUser:
+    """About the fields discord.py keeps for a user"""
+    __slots__ = ("id", "name", "discriminator", "global_name", "_avatar", "bot", "system", "_public_flags", "_banner", "_accent_colour")
+
+    def __init__(self, data):
+        self.id = int(data["id"])
+        self.name = data["username"]
+        self.discriminator = data["discriminator"]
+        self.global_name = data.get("global_name")
+        self._avatar = data.get("avatar")
+        self.bot = data.get("bot", False)
+        self.system = data.get("system", False)
+        self._public_flags = data.get("public_flags", 0)
+        self._banner = None
+        self._accent_colour = None
+
+class FakeMember:
+    """About the fields discord.py keeps for a member (the roles as an array of ids, like discord.py)"""
+    __slots__ = ("_user", "guild", "joined_at", "_roles", "nick", "premium_since", "_avatar", "pending", "timed_out_until", "_flags")
+
+    def __init__(self, data, guild):
+        self._user = FakeUser(data["user"])
+        self.guild = guild
+        self.joined_at = data["joined_at"]
+        self._roles = array("Q", sorted(int(role_id) for role_id in data["roles"]))
+        self.nick = data.get("nick")
+        self.premium_since = None
+        self._avatar = None
+        self.pending = data.get("pending", False)
+        self.timed_out_until = None
+        self._flags = data.get("flags", 0)
+
+    @property
+    def id(self):
+        return self._user.id
+
+    @property
+    def bot(self):
+        return self._user.bot
+
+    @property
+    def roles(self):
+        return [self.guild.roles[role_id] for role_id in self._roles]
+
+    @property
+    def guild_permissions(self):
+        return FakeRole(0, "", any(role.administrator for role in self.roles))
+
+class FakeGuild:
+    """A guild as discord.py has it after GUILD_CREATE: the roles and the member count, but no members until it is chunked"""
+    def __init__(self, guild_id, size, rng, chunk_delay):
+        self.id = guild_id
+        self.member_count = size
+        self.seed = rng.random()
+        self.chunk_delay = chunk_delay
+        self.roles = {1: FakeRole(1, "@everyone"), 2: FakeRole(2, "Admin", True), 3: FakeRole(3, "Member"), 4: FakeRole(4, "Runner"), 5: FakeRole(5, "Chaser")}
+        self._members = {}
+        self.chunked = False
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    async def fetch_member(self, member_id):
+        return self._members[member_id]
+
+    def chunk_payload(self, start, rng):
+        """What discord sends for one GUILD_MEMBERS_CHUNK event, as json"""
+        members = []
+        for i in range(start, min(start + CHUNK_SIZE, self.member_count)):
+            roles = ["1"] + (["2"] if rng.random() < 0.01 else []) + (["3"] if rng.random() < 0.5 else [])
+            user = {"id": str(self.id * 10 ** 7 + i), "username": f"user{i}", "discriminator": "0", "global_name": f"User {i}", "avatar": "a" * 32, "public_flags": 0}
+            if rng.random() < 0.01:
+                user["bot"] = True
+            members.append({"user": user, "roles": roles, "joined_at": "2023-06-01T12:00:00.000000+00:00", "nick": None, "pending": False, "flags": 0, "deaf": False, "mute": False})
+        return json.dumps({"guild_id": str(self.id), "members": members, "chunk_index": start // CHUNK_SIZE, "chunk_count": -(-self.member_count // CHUNK_SIZE)})
+
+    async def chunk(self):
+        rng = random.Random(self.seed)
+        for start in range(0, self.member_count, CHUNK_SIZE):
+            # the time for discord to send the chunk
+            await asyncio.sleep(self.chunk_delay)
+            data = json.loads(self.chunk_payload(start, rng))
+            for member_data in data["members"]:
+                member = FakeMember(member_data, self)
+                self._members[member.id] = member
+        self.chunked = True
+
+def make_guilds(sizes, small, rng, chunk_delay):
+    sizes = list(sizes) + [rng.randint(10, 200) for _ in range(small)]
+    return [FakeGuild(guild_id, size, rng, chunk_delay) for guild_id, size in enumerate(sizes, start=1)]
+
+async def run(setting, args):
+    """Start one setting and print its results as json (this runs in its own process)"""
+    rng = random.Random(args.seed)
+    guilds = make_guilds(args.sizes, args.small, rng, args.chunk_delay)
+    playing = rng.sample(guilds, min(args.playing, len(guilds)))
+    game_status = GameStatus()
+    started = time.perf_counter()
+    if setting == "all":
+        # chunk_guilds_at_startup: discord.py chunks every guild before on_ready
+        await asyncio.gather(*[guild.chunk() for guild in guilds])
+    ready = time.perf_counter() - started
+    ready_memory = peak_mb()
+    # then the guilds that play start a game, the first check loads (and if needed chunks) their members
+    checks = []
+    for guild in playing:
+        begin = time.perf_counter()
+        status = await game_status.loaded(guild)
+        status.running()
+        checks.append(time.perf_counter() - begin)
+    print(json.dumps({"ready": ready, "ready_memory": ready_memory, "memory": peak_mb(), "first_check": max(checks) if checks else 0, "cached": sum(len(guild._members) for guild in guilds)}))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the time until on_ready and the peak memory with and without cache_all_members")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 20000, 5000], help="members of the big guilds")
+    parser.add_argument("--small", type=int, default=500, help="amount of small guilds (10 to 200 members)")
+    parser.add_argument("--playing", type=int, default=10, help="guilds that start a game after on_ready")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds for discord to send one chunk of 1000 members")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--setting", choices=["all", "lazy"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.setting is not None:
+        asyncio.run(run(args.setting, args))
+        return
+
+    print(f"{len(args.sizes) + args.small} guilds, {sum(args.sizes)} members in the big ones, {args.playing} playing")
+    print(f"{'setting':>24}  {'on_ready':>9}  {'peak at ready':>13}  {'peak after':>10}  {'slowest first check':>19}  {'cached members':>14}")
+    for setting, name in [("all", "cache_all_members: true"), ("lazy", "cache_all_members: false")]:
+        output = subprocess.run([sys.executable, __file__, "--setting", setting] + sys.argv[1:], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        memory = lambda mb: f"{mb:>8.0f}MB" if mb is not None else "?"
+        print(f"{name:>24}  {result['ready']:>8.2f}s  {memory(result['ready_memory']):>13}  {memory(result['memory']):>10}  {result['first_check'] * 1000:>17.0f}ms  {result['cached']:>14}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""The chatlog of every guild (written in the background, searchable with /search) and the archive of the attachments."""
+import asyncio
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import aiohttp
+
+def safe_name(name):
+    """A channel name that can be used as a folder name: only letters, digits, - and _, so a channel called "../something" can't get out of the chatlog folder.
+    If something had to be replaced a bit of the hash of the name is added, so two different channels don't end up in the same folder."""
+    safe = re.sub(r"[^A-Za-z0-9_-]", "_", name)[:80]
+    if safe != name:
+        safe += "-" + hashlib.sha256(name.encode()).hexdigest()[:8]
+    return safe
+
+class ChatlogWriter:
+    """Writes the chatlog in the background, instead of opening the file for every message.
+    Messages are put in a queue, and a task writes them in batches (every flush_interval seconds, or sooner if there is a lot) in a thread.
+
+    The log of every channel is split in segments (<directory>/<safe channel name>/segment-00001.jsonl, one json message per line). When a segment is full it is gzipped,
+    and <directory>/index.json keeps the time range, message ids and authors of every segment, so /search only has to read the segments that can match."""
+    def __init__(self, directory="chatlog", archive_directory="chatlog_archive", flush_interval=1.0, flush_size=64 * 1024, segment_size=1024 * 1024, keep_archives=5, max_queue=100000):
+        self.directory = directory
+        self.archive_directory = archive_directory
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.segment_size = segment_size
+        self.keep_archives = keep_archives
+        self.queue = asyncio.Queue(max_queue)
+        self.files = {}
+        self.index = None
+        self.index_lock = threading.Lock()
+        self.task = None
+        self.max_depth = 0
+        self.dropped = 0
+        self.failed = 0
+        self.restarts = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        elif self.task.done():
+            # the writer should never stop by itself, but if it does start a new one instead of letting the queue grow forever
+            if not self.task.cancelled() and self.task.exception() is not None:
+                print(f"The chatlog writer stopped: {self.task.exception()!r}, starting it again")
+            self.restarts += 1
+            self.task = asyncio.create_task(self._run())
+
+    def write(self, channel, message):
+        """Queue a message (a dict with ts, id, author, author_id and content) for the chatlog of a channel (doesn't block)"""
+        if self.task is not None:
+            self.start()
+        try:
+            self.queue.put_nowait((channel, json.dumps(message) + "\n", message))
+        except asyncio.QueueFull:
+            self.dropped += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def depth(self):
+        """The amount of messages waiting to be written"""
+        return self.queue.qsize()
+
+    async def _run(self):
+        batch, size, deadline = [], 0, 0
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+            if item is not None and callable(item[0]):
+                # something that has to happen in the writer thread (flush, rotate), everything before it has to be written first
+                action, future = item
+                await self._write(batch)
+                batch, size = [], 0
+                try:
+                    result = await asyncio.to_thread(action)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                continue
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+                size += len(item[1])
+            if batch and (item is None or size >= self.flush_size):
+                await self._write(batch)
+                batch, size = [], 0
+
+    async def _write(self, batch):
+        """Write a batch, a batch that can't be written (disk full, no permission) is counted and skipped, so the writer keeps going"""
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"Could not write {len(batch)} chatlog messages: {e!r}")
+            # the open files and the index in memory may not match what is on disk anymore, start again from the disk
+            await asyncio.to_thread(self._reset)
+
+    def _reset(self):
+        """Runs in a thread"""
+        try:
+            self._close_files()
+        except OSError:
+            self.files = {}
+        with self.index_lock:
+            self.index = None
+
+    def _load_index(self):
+        """Runs in a thread. Every change to the index happens under index_lock, because search() copies it on the loop at the same time."""
+        if self.index is None:
+            try:
+                with open(os.path.join(self.directory, "index.json"), "r") as file:
+                    index = json.load(file)
+            except (FileNotFoundError, ValueError):
+                index = {}
+            with self.index_lock:
+                if self.index is None:
+                    self.index = index
+        return self.index
+
+    def _save_index(self):
+        with self.index_lock:
+            data = json.dumps(self.index)
+        with open(os.path.join(self.directory, "index.json.tmp"), "w") as file:
+            file.write(data)
+        os.replace(os.path.join(self.directory, "index.json.tmp"), os.path.join(self.directory, "index.json"))
+
+    def _write_batch(self, batch):
+        """Runs in a thread"""
+        if not batch:
+            return
+        # no chatlog folder means no game has been started yet, same as before: just skip it
+        if not os.path.isdir(self.directory):
+            self.dropped += len(batch)
+            return
+        index = self._load_index()
+        for channel, line, message in batch:
+            with self.index_lock:
+                segments = index.setdefault(channel, [])
+            if not segments or segments[-1]["compressed"]:
+                os.makedirs(os.path.join(self.directory, safe_name(channel)), exist_ok=True)
+                with self.index_lock:
+                    segments.append({"file": os.path.join(safe_name(channel), f"segment-{len(segments) + 1:05d}.jsonl"), "compressed": False, "first": message["ts"], "last": message["ts"], "first_id": message["id"], "last_id": message["id"], "authors": [], "messages": 0, "bytes": 0})
+            segment = segments[-1]
+            if channel not in self.files:
+                self.files[channel] = open(os.path.join(self.directory, segment["file"]), "a")
+            self.files[channel].write(line)
+            with self.index_lock:
+                segment["last"], segment["last_id"] = message["ts"], message["id"]
+                segment["messages"] += 1
+                segment["bytes"] += len(line)
+                if message["author_id"] not in segment["authors"]:
+                    segment["authors"].append(message["author_id"])
+            if segment["bytes"] >= self.segment_size:
+                self._roll(channel, segment)
+        for file in self.files.values():
+            file.flush()
+        self._save_index()
+
+    def _roll(self, channel, segment):
+        """Compress a full segment, the next message starts a new one"""
+        self.files.pop(channel).close()
+        path = os.path.join(self.directory, segment["file"])
+        with open(path, "rb") as source, gzip.open(path + ".gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.remove(path)
+        with self.index_lock:
+            segment["file"] += ".gz"
+            segment["compressed"] = True
+
+    def _close_files(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+    def _rotate(self):
+        """Move the current chatlog to the archive (a rename, so it's quick) and start an empty one. Only the newest archives are kept."""
+        self._close_files()
+        with self.index_lock:
+            self.index = None
+        if os.path.isdir(self.directory):
+            os.makedirs(self.archive_directory, exist_ok=True)
+            os.replace(self.directory, os.path.join(self.archive_directory, f"chatlog-{int(time.time() * 1000)}"))
+            for old in sorted(os.listdir(self.archive_directory))[:-self.keep_archives]:
+                shutil.rmtree(os.path.join(self.archive_directory, old), ignore_errors=True)
+        for channel in ["main", "chasers-only", "runners-only"]:
+            os.makedirs(os.path.join(self.directory, safe_name(channel)))
+
+    async def _in_writer(self, action):
+        """Run something in the writer (after everything that is queued now is written)"""
+        if self.task is None:
+            return await asyncio.to_thread(action)
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((action, future))
+        return await future
+
+    async def flush(self):
+        """Wait until everything that is queued now is written"""
+        await self._in_writer(lambda: None)
+
+    async def rotate(self):
+        """Archive the chatlog of the last game and start a new one (for /start)"""
+        await self._in_writer(self._rotate)
+
+    async def close(self):
+        await self._in_writer(self._close_files)
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def _search(self, segments, author_id, since, until, text, limit):
+        """Runs in a thread, reads the segments (the one with the newest message first) and returns the newest matching messages of all channels, oldest first.
+        The segments of different channels overlap in time, so it only stops when the next segment can't have anything newer than the messages found so far."""
+        # a heap of (ts, id, channel, message), the oldest of the newest limit messages on top
+        results = []
+        for channel, segment in reversed(segments):
+            if len(results) >= limit and segment["last"] < results[0][0]:
+                break
+            path = os.path.join(self.directory, segment["file"])
+            try:
+                with (gzip.open(path, "rt") if segment["compressed"] else open(path, "r")) as file:
+                    lines = file.readlines()
+            except FileNotFoundError:
+                continue
+            for line in reversed(lines):
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if author_id is not None and message["author_id"] != author_id:
+                    continue
+                if (since is not None and message["ts"] < since) or (until is not None and message["ts"] > until):
+                    continue
+                if text is not None and text.lower() not in message["content"].lower():
+                    continue
+                if len(results) >= limit and message["ts"] <= results[0][0]:
+                    # the lines are newest first, the rest of this segment is older
+                    break
+                heapq.heappush(results, (message["ts"], message["id"], channel, message))
+                if len(results) > limit:
+                    heapq.heappop(results)
+        return [(channel, message) for _, _, channel, message in sorted(results)]
+
+    async def search(self, channel=None, author_id=None, since=None, until=None, text=None, limit=20):
+        """Find messages in the chatlog. Only the segments whose channel, time range and authors fit are read."""
+        await self.flush()
+        if self.index is None:
+            await asyncio.to_thread(self._load_index)
+        with self.index_lock:
+            # a copy, the writer thread keeps changing the index while the segments are picked
+            index = json.loads(json.dumps(self.index)) if self.index is not None else {}
+        segments = []
+        for segment_channel, channel_segments in index.items():
+            if channel is not None and segment_channel != channel:
+                continue
+            for segment in channel_segments:
+                if since is not None and segment["last"] < since:
+                    continue
+                if until is not None and segment["first"] > until:
+                    continue
+                if author_id is not None and author_id not in segment["authors"]:
+                    continue
+                segments.append((segment_channel, segment))
+        segments.sort(key=lambda item: item[1]["last"])
+        return await asyncio.to_thread(self._search, segments, author_id, since, until, text, limit)
+
+class ChatlogRegistry:
+    """The ChatlogWriter of every guild, each with its own folder (chatlog/<guild id>) and archive, so /start in one server doesn't archive the chatlog of another"""
+    def __init__(self, directory="chatlog", archive_directory="chatlog_archive"):
+        self.directory = directory
+        self.archive_directory = archive_directory
+        self.guilds = {}
+
+    def get(self, guild):
+        if guild.id not in self.guilds:
+            writer = ChatlogWriter(os.path.join(self.directory, str(guild.id)), os.path.join(self.archive_directory, str(guild.id)))
+            writer.start()
+            self.guilds[guild.id] = writer
+        return self.guilds[guild.id]
+
+    async def close(self):
+        await asyncio.gather(*[writer.close() for writer in self.guilds.values()])
+
+class AttachmentArchiver:
+    """Saves the attachments by their content: chatlog/<guild id>/attachments/<sha256>.<extension>, with a manifest per channel (chatlog/<guild id>/<safe channel name>/manifest.jsonl) saying which message and filename it was.
+    The same photo twice is only stored once, and two attachments with the same name don't overwrite each other anymore.
+    Downloads are streamed to disk with a size limit, and only a few run at the same time."""
+    def __init__(self, directory="chatlog", max_concurrent=4, max_bytes=25 * 1024 * 1024, chunk_size=64 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.session = None
+        self.saved = 0
+        self.duplicates = 0
+        self.failed = 0
+
+    async def save(self, attachment, guild, channel, message_id=None):
+        """Archive one attachment. Returns the path it is stored at, or None if it wasn't saved (too big, download failed, or no chatlog folder for the channel)"""
+        guild_directory = os.path.join(self.directory, str(guild.id))
+        channel_directory = os.path.join(guild_directory, safe_name(channel))
+        if not os.path.isdir(channel_directory) or attachment.size > self.max_bytes:
+            self.failed += 1
+            return None
+        async with self.semaphore:
+            if self.session is None:
+                self.session = aiohttp.ClientSession()
+            objects = os.path.join(guild_directory, "attachments")
+            os.makedirs(objects, exist_ok=True)
+            temp_path = os.path.join(objects, f".{attachment.id}.part")
+            sha = hashlib.sha256()
+            size = 0
+            try:
+                async with self.session.get(attachment.url) as response:
+                    response.raise_for_status()
+                    file = await asyncio.to_thread(open, temp_path, "wb")
+                    try:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            size += len(chunk)
+                            if size > self.max_bytes:
+                                raise ValueError(f"{attachment.filename} is bigger than {self.max_bytes} bytes")
+                            sha.update(chunk)
+                            await asyncio.to_thread(file.write, chunk)
+                    finally:
+                        await asyncio.to_thread(file.close)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError):
+                self.failed += 1
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return None
+
+            path = os.path.join(objects, sha.hexdigest() + os.path.splitext(attachment.filename)[1].lower())
+            if os.path.exists(path):
+                self.duplicates += 1
+                os.remove(temp_path)
+            else:
+                self.saved += 1
+                os.replace(temp_path, path)
+            entry = {"message": message_id, "attachment": attachment.id, "filename": attachment.filename, "sha256": sha.hexdigest(), "size": size, "path": os.path.relpath(path, guild_directory)}
+            await asyncio.to_thread(self._add_to_manifest, channel_directory, entry)
+            return path
+
+    def _add_to_manifest(self, channel_directory, entry):
+        with open(os.path.join(channel_directory, "manifest.jsonl"), "a") as file:
+            file.write(json.dumps(entry) + "\n")
+
+    async def save_all(self, attachments, guild, channel, message_id=None):
+        """Archive all attachments of a message at the same time"""
+        return await asyncio.gather(*[self.save(attachment, guild, channel, message_id) for attachment in attachments])
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
@@ -0,0 +1,249 @@
+"""The rules of the game, the coins of the players and who is playing, without anything of discord (the guilds and members are only used through their attributes).
+Jetlag_Tag.py uses this for the commands, simulate.py plays (a lot of) games with it, bench_checks.py times the checks with it and the tests folder tests it."""
+import asyncio
+import random
+from collections import OrderedDict
+
+START_COINS = 2000
+TAGGED_BONUS = 300
+VETO_SECONDS = 30 * 60
+POWERUP_SECONDS = 10 * 60
+
+# price per minute
+TRAVEL_COSTS = {
+    "[25 coins] high-speed rail": 25,
+    "[10 coins] low-speed rail": 10,
+    "[5 coins] local bus/tram/metro": 5,
+    "[100 coins] plane": 100,
+    "[10 coins] ferry": 10,
+    "[1 coin] bike/scooter": 1,
+}
+
+SHOP_PRICES = {
+    "double": 250,
+    "tracker_off": 1500,
+    "find_chasers": 1000,
+    "chasers_still": 2000,
+}
+
+def travel_cost(method, minutes):
+    """The cost of traveling with a method for some minutes, or None if the method doesn't exist"""
+    if method not in TRAVEL_COSTS:
+        return None
+    return TRAVEL_COSTS[method] * minutes
+
+def deal(members, destinations, rng=random):
+    """The players list of a new game: the first (shuffled) member is the runner, everyone gets a (shuffled) destination and the start coins.
+    A row is [member, destination, role, coins]."""
+    destinations = list(destinations)
+    members = list(members)
+    rng.shuffle(destinations)
+    rng.shuffle(members)
+    return [[member, destination, "Runner" if i == 0 else "Chaser", START_COINS] for i, (member, destination) in enumerate(zip(members, destinations))]
+
+class GameState:
+    """The state of one game, and what the commands do to it. Coins are not changed here (the bot does that through its wallet), the methods only say how much."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.players = None
+        self.double_active = False
+        self.card_active = False
+        self.veto_active = False
+        self.current_card = None
+        self.veto_end_time = 0
+        self.full_round_done = False
+
+    def start(self, members, destinations, rng=random):
+        self.reset()
+        self.players = deal(members, destinations, rng)
+        return self.players
+
+    def vetoed(self, now):
+        """If a veto is blocking drawing cards and buying things"""
+        return now < self.veto_end_time
+
+    def buy_double(self):
+        self.double_active = True
+
+    def draw(self, card):
+        self.card_active = True
+        self.current_card = card
+
+    def finish(self):
+        """Finish the current card, returns the reward (doubled if the powerup was bought)"""
+        reward = self.current_card.reward
+        if self.double_active:
+            reward *= 2
+            self.double_active = False
+        self.card_active = False
+        self.current_card = None
+        return reward
+
+    def veto(self, now):
+        """Veto the current card, returns when the veto ends (twice as long if the powerup was bought)"""
+        self.veto_end_time = int(now) + (VETO_SECONDS * 2 if self.double_active else VETO_SECONDS)
+        self.card_active = False
+        self.veto_active = True
+        self.double_active = False
+        return self.veto_end_time
+
+    def tagged(self):
+        """The runner got tagged: the next player becomes the runner. Returns the row of the player that gets the bonus, or None.
+        The bonus is only given once a full round has been done."""
+        self.double_active = False
+        self.card_active = False
+        self.veto_active = False
+        self.current_card = None
+        self.veto_end_time = 0
+        runner = next((i for i, player in enumerate(self.players) if player[2] == "Runner"), None)
+        if runner is None:
+            # nobody is the runner (fixed with /manual), so there is nothing to switch
+            return None
+        following = (runner + 1) % len(self.players)
+        self.players[runner][2] = "Chaser"
+        self.players[following][2] = "Runner"
+        if self.full_round_done:
+            return self.players[following]
+        if following == 0:
+            self.full_round_done = True
+        return None
+
+class Wallet:
+    """The coins of the players. A player is looked up by member id (instead of going through the players list), and every change happens under a lock, so two purchases at the same time can't spend the same coins.
+    A change can have a key (like the id of the interaction), and a key that was already used for a change just gets the same answer again, so one interaction can never pay twice.
+    on_change is called with the row after every change (the bot saves the coins with it)."""
+    def __init__(self, on_change=None, max_keys=4096):
+        self.on_change = on_change
+        self.max_keys = max_keys
+        self.rows = {}
+        self.keys = OrderedDict()
+        self.lock = asyncio.Lock()
+
+    def reset(self, players):
+        """Use the rows of a (new) players list"""
+        self.rows = {player[0].id: player for player in players}
+        self.keys.clear()
+
+    def balance(self, member):
+        """The coins of a member, or None if they aren't playing"""
+        row = self.rows.get(member.id)
+        return row[3] if row is not None else None
+
+    async def _change(self, member, amount, key, allow_negative):
+        async with self.lock:
+            if key is not None and key in self.keys:
+                return "duplicate", self.keys[key][1]
+            row = self.rows.get(member.id)
+            if row is None:
+                result = ("unknown", None)
+            elif not allow_negative and row[3] + amount < 0:
+                result = ("insufficient", row[3])
+            else:
+                row[3] += amount
+                if self.on_change is not None:
+                    self.on_change(row)
+                result = ("ok", row[3])
+            # only a payment that went through uses up the key, after "insufficient" the same shop can still buy something cheaper
+            if key is not None and result[0] == "ok":
+                self.keys[key] = result
+                while len(self.keys) > self.max_keys:
+                    self.keys.popitem(last=False)
+            return result
+
+    async def debit(self, member, amount, key=None):
+        """Take coins, only if there are enough. Returns ("ok", new balance), ("insufficient", balance), ("unknown", None) or ("duplicate", balance) if the key was used before."""
+        return await self._change(member, -amount, key, False)
+
+    async def credit(self, member, amount, key=None):
+        return await self._change(member, amount, key, True)
+
+    async def set(self, member, coins):
+        async with self.lock:
+            row = self.rows.get(member.id)
+            if row is None:
+                return False
+            row[3] = coins
+            if self.on_change is not None:
+                self.on_change(row)
+            return True
+
+class GuildStatus:
+    """Who has a game role (Runner or Chaser) and who could play (no bots or admins) in a guild, kept up to date by the member and role events.
+    This way the checks don't have to go through all members (and all their roles) for every command.
+    The members of a guild are only loaded (chunked into the cache of discord.py) the first time a check needs them, so servers that never play don't cost anything.
+    After that the cache is kept up to date by discord.py, and a rebuild only goes through the cached members (no requests)."""
+    GAME_ROLES = ["Runner", "Chaser"]
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.in_game = set()
+        self.eligible = set()
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    async def load(self):
+        """Go through all the members once (chunking the guild first if that hasn't happened yet)"""
+        async with self.lock:
+            if self.loaded:
+                return
+            if not self.guild.chunked:
+                await self.guild.chunk()
+            self.in_game = set()
+            self.eligible = set()
+            for member in self.guild.members:
+                self.update_member(member)
+            self.loaded = True
+
+    def rebuild(self):
+        """Go through the members again the next time it's needed (after a game role or the admin permission of a role changed)"""
+        self.loaded = False
+
+    @staticmethod
+    def role_matters(role):
+        """If a change to this role can change who is in the game or who could play"""
+        return role.name in GuildStatus.GAME_ROLES or role.permissions.administrator
+
+    def update_member(self, member):
+        if any(role.name in GuildStatus.GAME_ROLES for role in member.roles):
+            self.in_game.add(member.id)
+        else:
+            self.in_game.discard(member.id)
+        if not member.bot and not member.guild_permissions.administrator:
+            self.eligible.add(member.id)
+        else:
+            self.eligible.discard(member.id)
+
+    def remove_member(self, member_id):
+        self.in_game.discard(member_id)
+        self.eligible.discard(member_id)
+
+    async def member(self, member_id):
+        """The member with their current roles: from the cache if the guild is chunked (kept up to date by discord.py), else fetched"""
+        member = self.guild.get_member(member_id) if self.guild.chunked else None
+        if member is None:
+            member = await self.guild.fetch_member(member_id)
+        return member
+
+    def running(self):
+        return len(self.in_game) > 0
+
+    def eligible_members(self):
+        return [member for member in map(self.guild.get_member, self.eligible) if member is not None]
+
+class GameStatus:
+    """The GuildStatus of every guild"""
+    def __init__(self):
+        self.guilds = {}
+
+    def get(self, guild):
+        if guild.id not in self.guilds:
+            self.guilds[guild.id] = GuildStatus(guild)
+        return self.guilds[guild.id]
+
+    async def loaded(self, guild):
+        """The GuildStatus of a guild, with its members loaded"""
+        status = self.get(guild)
+        await status.load()
+        return status
@@ -0,0 +1,123 @@
+"""Saving the games of all guilds in a sqlite database, so a restart in the middle of a game can continue where it was (see GameStore)."""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+class GameStore:
+    """Saves the game state, so a restart in the middle of a game can continue where it was.
+    Every change (coins, roles, cards, vetos) is an event in an append-only table in a sqlite database (in WAL mode), and every so often a snapshot of the whole state is saved.
+    Starting up is loading the last snapshot and applying the events after it. Events are written in batches by a background task, in a thread."""
+    def __init__(self, path="gamestate.db", snapshot_every=100, flush_interval=0.5):
+        self.snapshot_every = snapshot_every
+        self.flush_interval = flush_interval
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        if self.db.execute("SELECT * FROM sqlite_master WHERE name = 'events'").fetchone() is not None and "guild" not in [row[1] for row in self.db.execute("PRAGMA table_info(events)")]:
+            # made by the version for one server, that game can't be given to a guild anymore
+            self.db.execute("DROP TABLE events")
+            self.db.execute("DROP TABLE IF EXISTS snapshots")
+        self.db.execute("CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, guild INTEGER, time REAL, type TEXT, data TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshots (guild INTEGER, seq INTEGER, time REAL, state TEXT, PRIMARY KEY (guild, seq))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_guild ON events (guild, seq)")
+        self.db.commit()
+        self.pending = []
+        self.since_snapshot = {}
+        self.task = None
+        self.write_lock = threading.Lock()
+        # held from taking a batch until it is written, so a flush can't write its events before an earlier batch
+        self.batch_lock = asyncio.Lock()
+        self.states = self.load()
+
+    @staticmethod
+    def empty_state():
+        return {"players": None, "coords": None, "card_active": False, "current_card": None, "double": False, "veto_end": 0, "full_round": False}
+
+    @staticmethod
+    def apply(state, type, data):
+        """Apply one event to the state (used both while playing and while loading)"""
+        if type == "start":
+            state.clear()
+            state.update(GameStore.empty_state(), players=data["players"], coords=data["coords"])
+        elif type == "stop":
+            state.clear()
+            state.update(GameStore.empty_state())
+        elif type == "coins":
+            for player in state["players"] or []:
+                if player[0] == data["member"]:
+                    player[3] = data["coins"]
+        elif type == "roles":
+            for player in state["players"] or []:
+                if str(player[0]) in data["roles"]:
+                    player[2] = data["roles"][str(player[0])]
+        else:
+            # card, double, veto and tagged only change some of the flags
+            state.update(data)
+
+    def load(self):
+        """The state of every guild: the newest snapshot, with the events after it applied"""
+        states = {}
+        guilds = self.db.execute("SELECT guild FROM events UNION SELECT guild FROM snapshots").fetchall()
+        for (guild,) in guilds:
+            state = GameStore.empty_state()
+            row = self.db.execute("SELECT seq, state FROM snapshots WHERE guild = ? ORDER BY seq DESC LIMIT 1", (guild,)).fetchone()
+            last_seq = 0
+            if row is not None:
+                last_seq, state = row[0], json.loads(row[1])
+            events = self.db.execute("SELECT type, data FROM events WHERE guild = ? AND seq > ? ORDER BY seq", (guild, last_seq)).fetchall()
+            for type, data in events:
+                GameStore.apply(state, type, json.loads(data))
+            self.since_snapshot[guild] = len(events)
+            states[guild] = state
+        return states
+
+    def state(self, guild_id):
+        if guild_id not in self.states:
+            self.states[guild_id] = GameStore.empty_state()
+        return self.states[guild_id]
+
+    def record(self, guild_id, type, **data):
+        """Save an event of a guild (doesn't block, it is written by the background task)"""
+        GameStore.apply(self.state(guild_id), type, data)
+        self.pending.append((guild_id, time.time(), type, json.dumps(data)))
+        self.since_snapshot[guild_id] = self.since_snapshot.get(guild_id, 0) + 1
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def _take_batch(self):
+        """The pending events, plus a snapshot of every guild that is due for one (of the state right after them)"""
+        events, self.pending = self.pending, []
+        snapshots = []
+        for guild_id in {event[0] for event in events}:
+            if self.since_snapshot[guild_id] >= self.snapshot_every:
+                snapshots.append((guild_id, json.dumps(self.states[guild_id])))
+                self.since_snapshot[guild_id] = 0
+        return events, snapshots
+
+    def _write(self, events, snapshots):
+        """Runs in a thread"""
+        with self.write_lock:
+            self.db.executemany("INSERT INTO events (guild, time, type, data) VALUES (?, ?, ?, ?)", events)
+            for guild_id, snapshot in snapshots:
+                seq = self.db.execute("SELECT MAX(seq) FROM events WHERE guild = ?", (guild_id,)).fetchone()[0] or 0
+                self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)", (guild_id, seq, time.time(), snapshot))
+            self.db.commit()
+
+    async def _write_pending(self):
+        async with self.batch_lock:
+            if self.pending:
+                await asyncio.to_thread(self._write, *self._take_batch())
+
+    async def _run(self):
+        try:
+            while self.pending:
+                await asyncio.sleep(self.flush_interval)
+                await self._write_pending()
+        finally:
+            self.task = None
+
+    async def flush(self):
+        """Write everything that is pending now (after a batch that is being written)"""
+        await self._write_pending()
@@ -0,0 +1,366 @@
+"""Turning place names into coords: the sqlite cache, the offline gazetteer, nominatim and the service that combines them (async, rate limited).
+DestinationIndex finds the closest destination for places once they are coords."""
+import asyncio
+import csv
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from lazy import np, geopy
+from monitoring import metrics
+
+class GeoCache:
+    """LRU cache for the geocoding results, saved in a sqlite file so it survives restarts.
+    Places that were not found are cached as well (for a while), so typos don't hit the network every time.
+    get and put only change the memory (they run on the event loop), the changes are collected and written to the file in one go with take_changes and write (in a thread)."""
+    MISSING = object()
+
+    def __init__(self, path="geocache.db", max_size=2048, not_found_ttl=24*60*60):
+        self.max_size = max_size
+        self.not_found_ttl = not_found_ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        # query -> row to save, or None to delete it
+        self.changed_rows = {}
+        # query -> when it was last used
+        self.used = {}
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS geocache (query TEXT PRIMARY KEY, lat REAL, lon REAL, found INTEGER, saved REAL, used REAL)")
+        self.db.commit()
+        # load the most recently used entries, oldest first so the order in the OrderedDict is right
+        rows = self.db.execute("SELECT query, lat, lon, found, saved FROM geocache ORDER BY used DESC LIMIT ?", (max_size,)).fetchall()
+        for query, lat, lon, found, saved in reversed(rows):
+            self.entries[query] = ({'lat': lat, 'lon': lon} if found else None, saved)
+
+    @staticmethod
+    def normalize(place):
+        """Lowercase and squash the whitespace, so "  New York" and "new york" are the same lookup"""
+        return " ".join(place.lower().split())
+
+    def get(self, place):
+        """Returns the coords, None if the place is known to not exist, or GeoCache.MISSING if it isn't cached"""
+        key = self.normalize(place)
+        entry = self.entries.get(key)
+        if entry is not None:
+            coords, saved = entry
+            if coords is not None or time.time() - saved < self.not_found_ttl:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                self.used[key] = time.time()
+                return dict(coords) if coords is not None else None
+            # the not found entry is too old, try again
+            del self.entries[key]
+        self.misses += 1
+        return GeoCache.MISSING
+
+    def put(self, place, coords):
+        """Save the coords (or None if the place wasn't found) for the place"""
+        key = self.normalize(place)
+        now = time.time()
+        self.entries[key] = (dict(coords) if coords is not None else None, now)
+        self.entries.move_to_end(key)
+        if coords is not None:
+            self.changed_rows[key] = (key, coords['lat'], coords['lon'], 1, now, now)
+        else:
+            self.changed_rows[key] = (key, None, None, 0, now, now)
+        self.used.pop(key, None)
+        # evict the least recently used entries, both in memory and (with the next write) on disk
+        while len(self.entries) > self.max_size:
+            old_key, _ = self.entries.popitem(last=False)
+            self.changed_rows[old_key] = None
+            self.used.pop(old_key, None)
+
+    def has_changes(self):
+        return len(self.changed_rows) > 0 or len(self.used) > 0
+
+    def take_changes(self):
+        """The changes since the last time, for write (called on the event loop)"""
+        changes = (self.changed_rows, self.used)
+        self.changed_rows, self.used = {}, {}
+        return changes
+
+    def write(self, changes):
+        """Save changes from take_changes to the file, in one transaction. Runs in a thread."""
+        rows, used = changes
+        with self.db_lock:
+            self.db.executemany("INSERT OR REPLACE INTO geocache VALUES (?, ?, ?, ?, ?, ?)", [row for row in rows.values() if row is not None])
+            self.db.executemany("DELETE FROM geocache WHERE query = ?", [(key,) for key, row in rows.items() if row is None])
+            self.db.executemany("UPDATE geocache SET used = ? WHERE query = ?", [(when, key) for key, when in used.items()])
+            self.db.commit()
+
+    def stats(self):
+        """Hit/miss counters, for debugging"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+class Gazetteer:
+    """Offline geocoder from a GeoNames style file (tab separated: id, name, ascii name, alternate names, lat, lon, ..., population in column 15).
+    Everything is stored in flat numpy arrays: a sorted name index for (prefix) lookups, and a kd-tree (implicit, stored as a permutation) for finding the nearest place.
+    The arrays are saved next to each other as .npy files, and memory mapped on startup so the file doesn't need to be parsed again."""
+    ARRAYS = ["lat", "lon", "population", "xyz", "tree", "keys", "key_offsets", "key_ids"]
+
+    def __init__(self, arrays):
+        for name in Gazetteer.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @staticmethod
+    def normalize(place):
+        """Like GeoCache.normalize, but also strips accents (São Paulo -> sao paulo)"""
+        place = unicodedata.normalize("NFKD", place)
+        return " ".join("".join(c for c in place if not unicodedata.combining(c)).lower().split())
+
+    @staticmethod
+    def unit_vectors(lat, lon):
+        """Converts lat/lon (in degrees) to points on the unit sphere, so the straight line distance gives the same order as the great circle distance."""
+        lat, lon = np.radians(lat), np.radians(lon)
+        return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+    @classmethod
+    def from_csv(cls, path):
+        """Parse the gazetteer file and build the indexes"""
+        lat, lon, population, names = [], [], [], []
+        with open(path, "r", encoding="utf-8", newline="") as file:
+            for row in csv.reader(file, delimiter="\t", quoting=csv.QUOTE_NONE):
+                if len(row) < 6:
+                    continue
+                try:
+                    lat.append(float(row[4]))
+                    lon.append(float(row[5]))
+                except ValueError:
+                    # probably a header
+                    continue
+                population.append(int(row[14]) if len(row) > 14 and row[14].isdigit() else 0)
+                names.append({cls.normalize(row[1]), cls.normalize(row[2])} - {""})
+
+        # the name index: every (normalized name, place) pair, sorted by the utf-8 bytes of the name
+        pairs = sorted((name.encode("utf-8"), i) for i, place_names in enumerate(names) for name in place_names)
+        key_offsets = np.zeros(len(pairs) + 1, dtype=np.int64)
+        key_offsets[1:] = np.cumsum([len(key) for key, _ in pairs])
+        arrays = {
+            "lat": np.array(lat, dtype=np.float32),
+            "lon": np.array(lon, dtype=np.float32),
+            "population": np.array(population, dtype=np.int64),
+            "keys": np.frombuffer(b"".join(key for key, _ in pairs), dtype=np.uint8),
+            "key_offsets": key_offsets,
+            "key_ids": np.array([i for _, i in pairs], dtype=np.int32),
+        }
+        arrays["xyz"] = cls.unit_vectors(arrays["lat"], arrays["lon"]).astype(np.float32)
+
+        # the kd-tree: for every range, the median (along the axis of that depth) is put in the middle, smaller ones left, bigger ones right
+        tree = np.arange(len(lat), dtype=np.int32)
+        stack = [(0, len(tree), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo <= 1:
+                continue
+            mid = (lo + hi) // 2
+            part = tree[lo:hi]
+            tree[lo:hi] = part[np.argpartition(arrays["xyz"][part, depth % 3], mid - lo)]
+            stack.append((lo, mid, depth + 1))
+            stack.append((mid + 1, hi, depth + 1))
+        arrays["tree"] = tree
+        return cls(arrays)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in Gazetteer.ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory):
+        """Memory map a saved index"""
+        return cls({name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in Gazetteer.ARRAYS})
+
+    @classmethod
+    def open(cls, csv_path, index_directory):
+        """Load the index, (re)building it first if the gazetteer file is newer. Returns None if there is no gazetteer at all."""
+        index_file = os.path.join(index_directory, "tree.npy")
+        if os.path.exists(csv_path) and (not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(csv_path)):
+            print("Building the gazetteer index")
+            cls.from_csv(csv_path).save(index_directory)
+        if not os.path.exists(index_file):
+            return None
+        return cls.load(index_directory)
+
+    def _key(self, i):
+        return self.keys[self.key_offsets[i]:self.key_offsets[i + 1]].tobytes()
+
+    def _bisect(self, query):
+        """Binary search for the first key >= query"""
+        lo, hi = 0, len(self.key_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < query:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, place, max_matches=1000):
+        """Find a place by name. An exact match is preferred, otherwise the names starting with it are used. If there are multiple, the biggest place wins. Returns None if nothing is found."""
+        query = self.normalize(place).encode("utf-8")
+        if not query:
+            return None
+        first = self._bisect(query)
+        matches = []
+        i = first
+        while i < len(self.key_ids) and len(matches) < max_matches and self._key(i) == query:
+            matches.append(int(self.key_ids[i]))
+            i += 1
+        # only use prefixes for longer names, otherwise "par" would be good enough for paris
+        if not matches and len(query) >= 4:
+            while i < len(self.key_ids) and len(matches) < max_matches and self._key(i).startswith(query):
+                matches.append(int(self.key_ids[i]))
+                i += 1
+        if not matches:
+            return None
+        best = max(matches, key=lambda place_id: self.population[place_id])
+        return {'lat': float(self.lat[best]), 'lon': float(self.lon[best])}
+
+    def nearest(self, lat, lon):
+        """Index of the place closest to the given coords (reverse geocoding)"""
+        target = self.unit_vectors(lat, lon)
+        best, best_distance = None, float("inf")
+        stack = [(0, len(self.tree), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            place_id = int(self.tree[mid])
+            distance = float(np.sum((self.xyz[place_id] - target) ** 2))
+            if distance < best_distance:
+                best, best_distance = place_id, distance
+            difference = float(target[depth % 3] - self.xyz[place_id][depth % 3])
+            near, far = ((lo, mid), (mid + 1, hi)) if difference < 0 else ((mid + 1, hi), (lo, mid))
+            # only look at the other side if it can contain something closer
+            if difference ** 2 < best_distance:
+                stack.append((far[0], far[1], depth + 1))
+            stack.append((near[0], near[1], depth + 1))
+        return best
+
+class NominatimBackend:
+    """The default geocoding backend. The domain and scheme can be changed (with the NOMINATIM_DOMAIN and NOMINATIM_SCHEME environment variables), so it can be pointed at a local stub server for testing."""
+    # nominatim's usage policy: max 1 request per second
+    min_interval = 1.0
+
+    def __init__(self, domain=None, scheme=None):
+        self.domain = domain or "nominatim.openstreetmap.org"
+        self.scheme = scheme or "https"
+        self.geolocator = None
+
+    def geocode(self, place):
+        """Blocking lookup, returns the coords or None if the place wasn't found. Runs in a worker thread."""
+        if self.geolocator is None:
+            self.geolocator = geopy.Nominatim(user_agent="jetlag", domain=self.domain, scheme=self.scheme)
+        location = self.geolocator.geocode(place)
+        if location is None:
+            return None
+        return {'lat': location.latitude, 'lon': location.longitude}
+
+class GeocodingService:
+    """Async geocoding, so the event loop doesn't freeze while waiting on the network.
+    Lookups run in a small thread pool, are spaced out to follow the backend's rate limit, and identical lookups that are already running are merged into one request.
+    If there is a local gazetteer, that is tried first and the network is only used when it doesn't know the place.
+    local is a function that opens the gazetteer, it's called the first time a place is looked up.
+    The changes to the cache are saved in the pool as well, at most once every save_interval seconds."""
+    def __init__(self, backend, cache, local=None, workers=4, save_interval=5.0):
+        self.backend = backend
+        self.cache = cache
+        self.open_local = local
+        self.local = None
+        self.local_lock = asyncio.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="geocode")
+        self.in_flight = {}
+        self.next_slot = 0
+        self.slot_lock = asyncio.Lock()
+        self.requests = 0
+        self.save_interval = save_interval
+        self.save_task = None
+
+    async def _wait_for_slot(self):
+        """Reserve the next free request slot and wait for it. The lock is only held while reserving, so the requests themselves still overlap."""
+        async with self.slot_lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.backend.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _fetch(self, place):
+        await self._wait_for_slot()
+        self.requests += 1
+        with metrics.timer("jetlag_nominatim_seconds"):
+            coords = await asyncio.get_running_loop().run_in_executor(self.pool, self.backend.geocode, place)
+        self.cache.put(place, coords)
+        self._save_cache_soon()
+        return coords
+
+    def _save_cache_soon(self):
+        if self.save_task is None and self.cache.has_changes():
+            self.save_task = asyncio.ensure_future(self._save_cache())
+
+    async def _save_cache(self):
+        """Wait a bit (so more changes go in the same write), then write the cache changes in the pool"""
+        try:
+            await asyncio.sleep(self.save_interval)
+            await self.save_cache()
+        finally:
+            self.save_task = None
+
+    async def save_cache(self):
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.pool, self.cache.write, self.cache.take_changes())
+        except sqlite3.Error as e:
+            print(f"Could not save the geocache: {e}")
+
+    async def lookup(self, place):
+        """Get the lat and lon of a location. Raises an AttributeError if it wasn't found."""
+        if self.open_local is not None:
+            async with self.local_lock:
+                if self.open_local is not None:
+                    # in a thread, it can have to build the index first
+                    self.local = await asyncio.to_thread(self.open_local)
+                    self.open_local = None
+        if self.local is not None:
+            coords = self.local.lookup(place)
+            if coords is not None:
+                return coords
+        coords = self.cache.get(place)
+        self._save_cache_soon()
+        if coords is GeoCache.MISSING:
+            key = GeoCache.normalize(place)
+            task = self.in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._fetch(place))
+                self.in_flight[key] = task
+                task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            # shield it, so one cancelled caller doesn't cancel the lookup for the others
+            coords = await asyncio.shield(task)
+        if coords is None:
+            raise AttributeError(f"{place} was not found")
+        return coords
+
+    async def lookup_many(self, places, return_exceptions=False):
+        """Look up multiple places at once (for /start). Raises an AttributeError if any of them wasn't found, or returns the errors in the list with return_exceptions."""
+        with metrics.call("geocode"):
+            return list(await asyncio.gather(*[self.lookup(place) for place in places], return_exceptions=return_exceptions))
+
+class DestinationIndex:
+    """The coords of the players' destinations (in the same order as the players list), resolved once at /start.
+    Finding who wins at a place is then one matrix product, for any amount of places at once."""
+    def __init__(self, coords):
+        self.coords = coords
+        self.vectors = Gazetteer.unit_vectors([c['lat'] for c in coords], [c['lon'] for c in coords])
+
+    def nearest(self, places):
+        """For every place (coords), the index of the closest destination (great circle distance, same as the map)"""
+        if not places:
+            return []
+        vectors = Gazetteer.unit_vectors([c['lat'] for c in places], [c['lon'] for c in places])
+        return np.argmax(vectors @ self.vectors.T, axis=1).tolist()
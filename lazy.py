@@ -0,0 +1,25 @@
+"""Modules that are only imported the first time they are used, so the bot starts quickly (see LazyModule)."""
+import importlib
+import time
+
+class LazyModule:
+    """A module that is only imported the first time something of it is used.
+    numpy, PIL, staticmap and geopy take a while to import, and only /start, /winner and the places need them."""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        # only called for what isn't on the LazyModule itself
+        if self.module is None:
+            begin = time.perf_counter()
+            self.module = importlib.import_module(self.name)
+            print(f"Imported {self.name} in {time.perf_counter() - begin:.2f}s")
+        return getattr(self.module, attribute)
+
+np = LazyModule("numpy")
+random = LazyModule("numpy.random")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+staticmap = LazyModule("staticmap")
+geopy = LazyModule("geopy")
@@ -0,0 +1,399 @@
+"""The map of a game: the tile cache, the projection, the win areas and rendering it all to a png (in a thread pool, see RenderQueue)."""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from io import BytesIO
+from math import pi, log, tan, cos, floor, ceil
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from geocoding import Gazetteer
+from lazy import np, Image, ImageDraw, staticmap
+from monitoring import metrics
+
+MAP_WIDTH, MAP_HEIGHT = 1600, 1200
+# can be pointed at a local tile server (for testing, or to be nice to the osm servers)
+TILE_URL_TEMPLATE = os.environ.get("JETLAG_TILE_URL", "https://tile.openstreetmap.org/{z}/{x}/{y}.png")
+TILE_HEADERS = {"User-Agent": "JetLag-The-Game-Tag-Discord-Bot"}
+
+def lon_to_x(lon, zoom):
+    """Longitude to the x position in tiles (same formula as staticmap)"""
+    if not (-180 <= lon <= 180):
+        lon = (lon + 180) % 360 - 180
+    return ((lon + 180.) / 360) * pow(2, zoom)
+
+def lat_to_y(lat, zoom):
+    """Latitude to the y position in tiles (same formula as staticmap)"""
+    if not (-90 <= lat <= 90):
+        lat = (lat + 90) % 180 - 90
+    return (1 - log(tan(lat * pi / 180) + 1 / cos(lat * pi / 180)) / pi) / 2 * pow(2, zoom)
+
+def fit_view(points, width, height, tile_size=256, padding=20):
+    """The highest zoom level (and the center) where all points fit on the map, roughly like staticmap does it. Padding is for the markers."""
+    lons = [point['lon'] for point in points]
+    lats = [point['lat'] for point in points]
+    for zoom in range(17, -1, -1):
+        if (lon_to_x(max(lons), zoom) - lon_to_x(min(lons), zoom)) * tile_size + 2 * padding > width:
+            continue
+        if (lat_to_y(min(lats), zoom) - lat_to_y(max(lats), zoom)) * tile_size + 2 * padding > height:
+            continue
+        break
+    return zoom, ((min(lons) + max(lons)) / 2, (min(lats) + max(lats)) / 2)
+
+def tiles_for_view(zoom, center, width, height, tile_size=256, margin=1):
+    """All the tile urls needed for a map with this zoom/center/size, with a margin of extra tiles around it"""
+    x_center, y_center = lon_to_x(center[0], zoom), lat_to_y(center[1], zoom)
+    x_min, x_max = floor(x_center - 0.5 * width / tile_size) - margin, ceil(x_center + 0.5 * width / tile_size) + margin
+    y_min, y_max = floor(y_center - 0.5 * height / tile_size) - margin, ceil(y_center + 0.5 * height / tile_size) + margin
+    tiles = 2 ** zoom
+    return [TILE_URL_TEMPLATE.format(z=zoom, x=x % tiles, y=y) for x in range(x_min, x_max) for y in range(y_min, y_max) if 0 <= y < tiles]
+
+class TileCache:
+    """Disk cache for the map tiles, saved as tiles/z/x/y.png with a small .json file next to it (etag and when it was last checked).
+    Old tiles are revalidated with a conditional request, and the least recently used tiles are removed when the cache gets too big.
+    Downloads go through a pooled requests session, and a tile that is already being downloaded isn't downloaded twice."""
+    TILE_PATTERN = re.compile(r"/(\d+)/(\d+)/(\d+)\.png")
+
+    def __init__(self, directory="tiles", max_bytes=256 * 1024 * 1024, max_age=7 * 24 * 60 * 60, workers=8):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tiles")
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        # the size of the tiles on disk, only counted when the first tile is downloaded (going through the whole folder at startup is slow)
+        self.size = None
+
+    def _count_size(self):
+        """Runs in a tile thread"""
+        with self.lock:
+            if self.size is not None:
+                return
+        size = 0
+        for root, _, files in os.walk(self.directory):
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in files if name.endswith(".png"))
+        with self.lock:
+            if self.size is None:
+                self.size = size
+
+    def path_for(self, url):
+        """tiles/z/x/y.png, or a hash of the url if the url doesn't look like that"""
+        match = TileCache.TILE_PATTERN.search(url)
+        if match is None:
+            return os.path.join(self.directory, "other", hashlib.sha1(url.encode()).hexdigest() + ".png")
+        return os.path.join(self.directory, *match.groups()[:2], f"{match.group(3)}.png")
+
+    def get(self, url, timeout=None, headers=None, **kwargs):
+        """Returns (status code, content) like staticmap's get, so it can replace it"""
+        path = self.path_for(url)
+        with self.lock:
+            future = self.in_flight.get(path)
+            owner = future is None
+            if owner:
+                future = self.in_flight[path] = Future()
+        if not owner:
+            return future.result()
+        try:
+            result = self._fetch(url, path, timeout or 30, headers)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[path]
+
+    def _fetch(self, url, path, timeout, headers):
+        meta = {}
+        content = None
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                content = file.read()
+            try:
+                with open(path + ".json", "r") as file:
+                    meta = json.load(file)
+            except (FileNotFoundError, ValueError):
+                pass
+            # bump it in the lru order
+            os.utime(path)
+            if time.time() - meta.get("checked", 0) < self.max_age:
+                self.hits += 1
+                return 200, content
+
+        self.misses += 1
+        request_headers = dict(TILE_HEADERS, **(headers or {}))
+        if content is not None and "etag" in meta:
+            request_headers["If-None-Match"] = meta["etag"]
+        if content is not None and "last_modified" in meta:
+            request_headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            with metrics.timer("jetlag_tile_download_seconds"):
+                response = self.session.get(url, timeout=timeout, headers=request_headers)
+        except requests.RequestException:
+            # an old tile is better than no tile
+            if content is not None:
+                return 200, content
+            raise
+        if response.status_code == 304 and content is not None:
+            meta["checked"] = time.time()
+            self._save_meta(path, meta)
+            return 200, content
+        if response.status_code != 200:
+            return (200, content) if content is not None else (response.status_code, response.content)
+
+        self._count_size()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as file:
+            file.write(response.content)
+        os.replace(path + ".tmp", path)
+        meta = {"checked": time.time()}
+        if "ETag" in response.headers:
+            meta["etag"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            meta["last_modified"] = response.headers["Last-Modified"]
+        self._save_meta(path, meta)
+        with self.lock:
+            self.size += len(response.content) - (len(content) if content is not None else 0)
+            too_big = self.size > self.max_bytes
+        if too_big:
+            self.evict()
+        return 200, response.content
+
+    def _save_meta(self, path, meta):
+        with open(path + ".json", "w") as file:
+            json.dump(meta, file)
+
+    def evict(self):
+        """Remove the least recently used tiles until the cache is at 90% of the max size"""
+        tiles = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".png"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    tiles.append((stat.st_mtime, stat.st_size, path))
+        tiles.sort()
+        size = sum(tile[1] for tile in tiles)
+        for _, tile_size, path in tiles:
+            if size <= self.max_bytes * 0.9:
+                break
+            for file in (path, path + ".json"):
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+            size -= tile_size
+        with self.lock:
+            self.size = size
+
+    def prefetch(self, urls):
+        """Start downloading the tiles in the background"""
+        for url in urls:
+            self.pool.submit(self.get, url)
+
+    def prefetch_points(self, points, width=MAP_WIDTH, height=MAP_HEIGHT):
+        """Warm the cache for the map of these points (as soon as they are geocoded). Only the tiles that are drawn, no margin: the tile servers don't want tiles downloaded that nobody looks at."""
+        self.prefetch(tiles_for_view(*fit_view(points, width, height), width, height, margin=0))
+
+tile_cache = TileCache()
+
+class MapProjection:
+    """Converts lat/lon to pixels on a rendered map, using the zoom and center staticmap used for it"""
+    def __init__(self, zoom, x_center, y_center, width, height, tile_size=256):
+        self.zoom = zoom
+        self.x_center = x_center
+        self.y_center = y_center
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+
+    def point_to_coords(self, point):
+        """Took this from the static map library and edited it down. Converts the lat and lon to the x and y coords on the map image."""
+        px = int(round((lon_to_x(point['lon'], self.zoom) - self.x_center) * self.tile_size + self.width / 2))
+        py = int(round((lat_to_y(point['lat'], self.zoom) - self.y_center) * self.tile_size + self.height / 2))
+        return px, py
+
+    def pixels_to_lonlat(self, step=1):
+        """point_to_coords the other way around, for the whole image at once. Returns the longitudes of the pixel columns and the latitudes of the pixel rows (every step pixels)."""
+        tiles = pow(2, self.zoom)
+        x = (np.arange(0, self.width, step) + 0.5 - self.width / 2) / self.tile_size + self.x_center
+        y = (np.arange(0, self.height, step) + 0.5 - self.height / 2) / self.tile_size + self.y_center
+        lons = (x / tiles * 360) % 360 - 180
+        lats = np.degrees(np.arctan(np.sinh(pi * (1 - 2 * y / tiles))))
+        return lons, lats
+
+# the colors of the win areas of the destinations, at a 40% opacity
+AREA_COLORS = [(150, 0, 0, 100), (0, 150, 0, 100), (150, 150, 0, 100)]
+
+class GameMap:
+    """The map of a game, kept small because every running game has one: the view (zoom and center), the destinations and the markers as points.
+    The base map comes from the base map cache (and is rendered again from the tile cache if it was dropped from it), the win areas and the full size images are only made while making a png."""
+    def __init__(self, view, projection, destinations, area_colors=AREA_COLORS):
+        self.view = view
+        self.projection = projection
+        self.destinations = destinations
+        self.area_colors = area_colors
+        self.markers = []
+
+    def add_marker(self, point, color):
+        self.markers.append((point, color))
+
+    @staticmethod
+    def draw_marker(draw, coords, color, radius=20):
+        draw.ellipse((coords[0] - radius, coords[1] - radius, coords[0] + radius, coords[1] + radius), fill=color)
+
+    def composite(self, extra_markers=()):
+        """The base map with the areas and the markers on it (plus some extra markers, without keeping them)"""
+        base, _ = render_base_map(*self.view)
+        # the areas where each of the destinations is the closest
+        with metrics.timer("jetlag_render_seconds", stage="areas"):
+            areas = win_areas(self.projection, self.destinations)
+        overlay = Image.fromarray(np.array(self.area_colors, dtype=np.uint8)[areas], 'RGBA')
+        draw = ImageDraw.Draw(overlay)
+        for point, color in self.markers + list(extra_markers):
+            self.draw_marker(draw, self.projection.point_to_coords(point), color)
+        return Image.alpha_composite(base, overlay)
+
+    def to_png(self, extra_markers=()):
+        image_bytes = BytesIO()
+        self.composite(extra_markers).save(image_bytes, format="PNG")
+        return image_bytes.getvalue()
+
+    def png_with_marker(self, point, color="blue"):
+        """The map with one extra marker on it (like a place asked about with /winner). The marker isn't kept."""
+        return self.to_png([(point, color)])
+
+def win_areas(projection, destinations, step=1):
+    """For every pixel the index of the closest destination (great circle distance), so the exact areas where each player would win. One byte per pixel.
+    Everything is done with numpy on the whole grid at once. The latitude only depends on the row and the longitude only on the column, so those are calculated once and combined."""
+    lons, lats = projection.pixels_to_lonlat(step)
+    lons, lats = np.radians(lons), np.radians(lats)
+    cos_lat, sin_lat = np.cos(lats)[:, None], np.sin(lats)[:, None]
+    cos_lon, sin_lon = np.cos(lons)[None, :], np.sin(lons)[None, :]
+    # the closest destination is the one with the biggest dot product between the unit vectors
+    closeness = np.stack([cos_lat * (cos_lon * d[0] + sin_lon * d[1]) + sin_lat * d[2] for d in Gazetteer.unit_vectors([d['lat'] for d in destinations], [d['lon'] for d in destinations])])
+    closest = np.argmax(closeness, axis=0).astype(np.uint8)
+    if step != 1:
+        closest = np.repeat(np.repeat(closest, step, axis=0), step, axis=1)[:projection.height, :projection.width]
+    return closest
+
+# the last few rendered base maps, by zoom/center/size
+base_maps = OrderedDict()
+base_maps_lock = threading.Lock()
+
+def render_base_map(zoom, center, width=MAP_WIDTH, height=MAP_HEIGHT):
+    """The map without anything on it, cached. Returns the image (RGBA) and the projection for it."""
+    key = (zoom, round(center[0], 6), round(center[1], 6), width, height)
+    with base_maps_lock:
+        if key in base_maps:
+            base_maps.move_to_end(key)
+            return base_maps[key]
+    static_map = staticmap.StaticMap(width, height, url_template=TILE_URL_TEMPLATE, headers=TILE_HEADERS)
+    # download the tiles through the tile cache
+    static_map.get = tile_cache.get
+    image = static_map.render(zoom=zoom, center=list(center)).convert('RGBA')
+    result = (image, MapProjection(static_map.zoom, static_map.x_center, static_map.y_center, width, height, static_map.tile_size))
+    with base_maps_lock:
+        base_maps[key] = result
+        while len(base_maps) > 8:
+            base_maps.popitem(last=False)
+    return result
+
+def download_map_with_points(points):
+    """Download a map with the given points and areas on it. The first point is the center, the second is red, the third is green and the fourth is yellow."""
+    view = fit_view(points, MAP_WIDTH, MAP_HEIGHT)
+    with metrics.timer("jetlag_render_seconds", stage="tiles"):
+        _, projection = render_base_map(*view)
+
+    game_map = GameMap(view, projection, points[1:])
+    for num, point in enumerate(points):
+        game_map.add_marker(point, ["black", "red", "green", "yellow"][num])
+    return game_map
+
+def render_map_png(points):
+    """Render the map and encode it as a png. This blocks for a while (downloading the tiles), so it runs in the render pool."""
+    game_map = download_map_with_points(points)
+    with metrics.timer("jetlag_render_seconds", stage="png"):
+        return game_map, game_map.to_png()
+
+class RenderQueue:
+    """Runs the slow map rendering in a thread pool, so the bot keeps responding (other commands, shop buttons) while a map is made.
+    Jobs wait in a queue for a free worker, have a timeout, and are skipped or dropped if whoever asked for them is cancelled.
+    The timeout starts when a thread picks the job up, so a thread that is still busy with a job that timed out doesn't use up the time of the jobs after it.
+    (threads instead of processes, because the heavy parts (tile downloads, png compression) release the GIL anyway, and the threads share the base map and tile caches)"""
+    def __init__(self, workers=2, timeout=120):
+        self.workers = workers
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+        self.queue = asyncio.Queue()
+        self.tasks = []
+
+    def start(self):
+        """Start the workers (needs a running event loop, so this happens on the first job)"""
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @staticmethod
+    def _run_job(loop, started, func, args):
+        """Runs in a render thread, tells the worker that the job started"""
+        loop.call_soon_threadsafe(started.set_result, None)
+        return func(*args)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            func, args, future, timeout = await self.queue.get()
+            try:
+                # the caller gave up while this job was waiting in the queue
+                if future.done():
+                    continue
+                started = loop.create_future()
+                job = loop.run_in_executor(self.pool, RenderQueue._run_job, loop, started, func, args)
+                await asyncio.wait([started, future], return_when=asyncio.FIRST_COMPLETED)
+                if not started.done():
+                    # the caller gave up while the job waited for a free thread
+                    job.cancel()
+                    continue
+                done, _ = await asyncio.wait([job, future], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if job in done:
+                    if not future.done():
+                        if job.exception() is not None:
+                            future.set_exception(job.exception())
+                        else:
+                            future.set_result(job.result())
+                else:
+                    # a thread can't be stopped, but its result will be thrown away
+                    job.cancel()
+                    if not future.done():
+                        future.set_exception(asyncio.TimeoutError(f"Rendering took longer than {timeout} seconds"))
+            finally:
+                self.queue.task_done()
+
+    async def submit(self, func, *args, timeout=None):
+        """Queue a blocking function and wait for its result"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((func, args, future, timeout or self.timeout))
+        with metrics.call("render"):
+            return await future
+
+    def pending(self):
+        """Amount of jobs waiting for a worker"""
+        return self.queue.qsize()
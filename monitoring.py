@@ -0,0 +1,288 @@
+"""The timings and counters of the bot (for /stats and the prometheus endpoint), the event loop lag and the sampling profiler of /profile.
+Nothing of discord in here, the bot tells it what happens."""
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+class Histogram:
+    """Counts how many times fell into each bucket (like prometheus), so it stays the same size however many are added"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(Histogram.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Roughly (the upper bound of the bucket it's in)"""
+        target = q * self.count
+        total = 0
+        for bound, count in zip(Histogram.BUCKETS + (self.max,), self.counts):
+            total += count
+            if total >= target:
+                return min(bound, self.max)
+        return self.max
+
+class CommandTiming:
+    """The timing of one command that is running, the stages are the time since the previous lap"""
+    def __init__(self, command):
+        self.command = command
+        self.started = time.perf_counter()
+        self.last = self.started
+
+class Metrics:
+    """Timings (histograms) and counters of the bot, shown by /stats and on a local prometheus endpoint (http://127.0.0.1:<metrics_port>/metrics).
+    The command that is running is kept in a context variable, so the calls it makes (geocoding, rendering, sending) are counted for that command."""
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.current = contextvars.ContextVar("command", default=None)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        key = Metrics._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def count(self, name, amount=1, **labels):
+        key = Metrics._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, function):
+        """A value that is read when the metrics are shown"""
+        self.gauges[name] = function
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - begin, **labels)
+
+    def call(self, call):
+        """Time a call (geocoding, rendering, sending) for the command that is running"""
+        timing = self.current.get()
+        return self.timer("jetlag_call_seconds", command=timing.command if timing is not None else "none", call=call)
+
+    def begin(self, command):
+        timing = CommandTiming(command)
+        self.current.set(timing)
+        return timing
+
+    def lap(self, stage):
+        """The time since the last lap (or the start) of the running command, as a stage"""
+        timing = self.current.get()
+        if timing is None:
+            return
+        now = time.perf_counter()
+        self.observe("jetlag_stage_seconds", now - timing.last, command=timing.command, stage=stage)
+        timing.last = now
+
+    def finish(self):
+        timing = self.current.get()
+        if timing is None:
+            return
+        self.observe("jetlag_command_seconds", time.perf_counter() - timing.started, command=timing.command)
+        self.count("jetlag_commands_total", command=timing.command)
+        self.current.set(None)
+
+    def counter(self, name, **labels):
+        return self.counters.get(Metrics._key(name, labels), 0)
+
+    def snapshot(self):
+        """Copies of the histograms and counters (the render threads can add new ones at any time)"""
+        with self.lock:
+            return dict(self.histograms), dict(self.counters)
+
+    def render(self):
+        """The prometheus text format"""
+        def label_text(labels, extra=()):
+            labels = list(labels) + list(extra)
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+        lines = []
+        with self.lock:
+            histograms = sorted((key, (list(h.counts), h.count, h.sum)) for key, h in self.histograms.items())
+            counters = sorted(self.counters.items())
+        for (name, labels), (counts, count, total) in histograms:
+            cumulative = 0
+            for bound, bucket in zip(Histogram.BUCKETS, counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{label_text(labels)} {total}")
+            lines.append(f"{name}_count{label_text(labels)} {count}")
+        for (name, labels), value in counters:
+            lines.append(f"{name}{label_text(labels)} {value}")
+        for name, function in sorted(self.gauges.items()):
+            try:
+                lines.append(f"{name} {function()}")
+            except Exception:
+                pass
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class RateLimitCounter(logging.Handler):
+    """discord.py handles 429s itself (it waits and tries again), it only logs them. This counts those log messages."""
+    def emit(self, record):
+        if "rate limit" in record.getMessage().lower():
+            metrics.count("jetlag_discord_429_total", logger=record.name)
+
+for logger_name in ["discord.http", "discord.webhook.async_"]:
+    logging.getLogger(logger_name).addHandler(RateLimitCounter(logging.WARNING))
+
+class LoopLagMonitor:
+    """Sleeps for a moment over and over, and measures how much later than asked it wakes up. If that's a lot, something is blocking the event loop."""
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            begin = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            metrics.observe("jetlag_event_loop_lag_seconds", max(0.0, time.perf_counter() - begin - self.interval))
+
+loop_lag = LoopLagMonitor()
+
+class SamplingProfiler:
+    """For /profile: while it runs, a thread looks at the stacks of all threads every interval (sys._current_frames), and a small task looks at what every asyncio task is waiting on.
+    It writes the stacks in the collapsed format (for flamegraph.pl or speedscope) and the coroutines by wall time to the profiles folder.
+    Nothing of it runs when no profile is being made, and the files are written in a thread."""
+    # stacks ending in these files are waiting (the event loop's select, idle pool threads), not working
+    IDLE_FILES = ("selectors.py", "threading.py", "queue.py", "thread.py")
+
+    def __init__(self, directory="profiles", interval=0.01, task_interval=0.02):
+        self.directory = directory
+        self.interval = interval
+        self.task_interval = task_interval
+        self.running = False
+
+    @staticmethod
+    def _frame_name(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample_threads(self, stacks, stop):
+        """Runs in its own thread"""
+        own = threading.get_ident()
+        while not stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(SamplingProfiler._frame_name(frame.f_code))
+                    frame = frame.f_back
+                stacks[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+
+    @staticmethod
+    def _innermost(coro):
+        """The coroutine (or generator) a coroutine is waiting in, at the bottom of the await chain"""
+        while True:
+            inner = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+            if inner is None or not (hasattr(inner, "cr_code") or hasattr(inner, "gi_code")):
+                return coro
+            coro = inner
+
+    def _sample_tasks(self, tasks):
+        own = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is own:
+                continue
+            coro = task.get_coro()
+            tasks[(getattr(coro, "__qualname__", repr(coro)), getattr(SamplingProfiler._innermost(coro), "__qualname__", "?"))] += 1
+
+    def _dump(self, stacks, tasks, seconds):
+        """Runs in a thread, returns the paths of the files"""
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.join(self.directory, f"profile-{int(time.time())}")
+        with open(name + ".collapsed", "w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        with open(name + "-tasks.txt", "w") as file:
+            file.write(f"wall time (s)\ttask coroutine\twaiting in ({seconds}s profiled)\n")
+            for (coro, waiting), count in tasks.most_common():
+                file.write(f"{count * self.task_interval:.2f}\t{coro}\t{waiting}\n")
+        return name + ".collapsed", name + "-tasks.txt"
+
+    def _summary(self, stacks, tasks, seconds, paths):
+        total = sum(stacks.values())
+        busy = Counter()
+        for stack, count in stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            if not any(f"({idle}:" in leaf for idle in SamplingProfiler.IDLE_FILES):
+                busy[f"{stack.split(';', 1)[0]}: {leaf}"] += count
+        msg = f"Profiled {seconds}s ({total} samples).\nBusiest (share of the samples, not waiting):\n"
+        for leaf, count in busy.most_common(5):
+            msg += f"    {100 * count / max(total, 1):.1f}% {leaf}\n"
+        msg += "Coroutines by wall time:\n"
+        coroutines = Counter()
+        for (coro, waiting), count in tasks.items():
+            coroutines[coro] += count
+        for coro, count in coroutines.most_common(5):
+            msg += f"    {count * self.task_interval:.1f}s {coro}\n"
+        return msg + f"Saved to {paths[0]} and {paths[1]}"
+
+    async def run(self, seconds):
+        """Profile for some seconds, write the files and return a summary"""
+        self.running = True
+        try:
+            stacks, tasks = Counter(), Counter()
+            stop = threading.Event()
+            thread = threading.Thread(target=self._sample_threads, args=(stacks, stop), name="profiler", daemon=True)
+            thread.start()
+            end = time.monotonic() + seconds
+            try:
+                while time.monotonic() < end:
+                    self._sample_tasks(tasks)
+                    await asyncio.sleep(self.task_interval)
+            finally:
+                stop.set()
+                await asyncio.to_thread(thread.join)
+            paths = await asyncio.to_thread(self._dump, stacks, tasks, seconds)
+            return self._summary(stacks, tasks, seconds, paths)
+        finally:
+            self.running = False
+
+profiler = SamplingProfiler()
+
+async def start_metrics_server(port):
+    """The prometheus endpoint, only on localhost"""
+    # only imported here, so the metrics can be used without the web server (it comes with discord.py anyway)
+    from aiohttp import web
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain")
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
@@ -0,0 +1,143 @@
+"""Sending messages while keeping to discord's rate limits (see Outbox). It only gets the send functions, so nothing of discord is imported here."""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict, deque
+
+from monitoring import metrics
+
+class PriorityGate:
+    """Like a semaphore, but when it's full the waiter with the lowest priority number goes first"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiters = []
+        self.counter = itertools.count()
+
+    async def acquire(self, priority):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # the slot was handed over just before the cancel, give it to the next one
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                # hand the slot over directly
+                future.set_result(None)
+                return
+        self.active -= 1
+
+class OutboxTarget:
+    """The queue of one destination (a channel, or the follow-ups of one interaction) and the times of the last messages sent to it"""
+    def __init__(self, send, rate, per):
+        self.send = send
+        self.rate = rate
+        self.per = per
+        self.queue = []
+        self.sent = deque(maxlen=rate)
+        self.task = None
+
+class Outbox:
+    """All messages of the bot go through here. Every destination has its own queue, which keeps track of discord's limits (5 messages per 5 seconds in a channel)
+    and waits before hitting them, instead of running into 429s and retries.
+    Text messages to the same destination that are queued shortly after each other are merged into one message, and when a lot is being sent at once, interaction follow-ups go before notices in channels."""
+    FOLLOWUP = 0
+    NOTICE = 1
+
+    def __init__(self, window=0.05, max_concurrent=8):
+        self.window = window
+        self.gate = PriorityGate(max_concurrent)
+        # least recently used first, a destination is kept (with the times of its last messages) until its window has passed
+        self.targets = OrderedDict()
+        self.counter = itertools.count()
+        self.sent = 0
+        self.merged = 0
+
+    async def followup(self, interaction, content=None, **kwargs):
+        """interaction.followup.send, through the outbox"""
+        with metrics.call("send"):
+            return await self._queue(("followup", interaction.id), interaction.followup.send, 5, 2.0, Outbox.FOLLOWUP, content, kwargs)
+
+    async def channel(self, channel, content=None, **kwargs):
+        """channel.send, through the outbox"""
+        with metrics.call("send"):
+            return await self._queue(("channel", channel.id), channel.send, 5, 5.0, Outbox.NOTICE, content, kwargs)
+
+    async def _queue(self, key, send, rate, per, priority, content, kwargs):
+        self._prune()
+        target = self.targets.get(key)
+        if target is None:
+            target = self.targets[key] = OutboxTarget(send, rate, per)
+        self.targets.move_to_end(key)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(target.queue, (priority, next(self.counter), content, kwargs, future))
+        if target.task is None:
+            target.task = asyncio.create_task(self._run(key, target))
+        return await future
+
+    def _prune(self):
+        """Forget the destinations that have nothing queued and whose last message is older than their window (their history can't make anything wait anymore)"""
+        now = time.monotonic()
+        while self.targets:
+            key, target = next(iter(self.targets.items()))
+            if target.task is not None or target.queue or (target.sent and now - target.sent[-1] < target.per):
+                break
+            del self.targets[key]
+
+    @staticmethod
+    def _mergeable(content, kwargs):
+        """Only plain text can be merged (an ephemeral flag is fine, as long as both have the same)"""
+        return isinstance(content, str) and set(kwargs) <= {"ephemeral"}
+
+    async def _run(self, key, target):
+        try:
+            while target.queue:
+                priority, _, content, kwargs, future = heapq.heappop(target.queue)
+                futures = [future]
+                if self._mergeable(content, kwargs):
+                    await asyncio.sleep(self.window)
+                    # merge the text messages right after this one
+                    while target.queue:
+                        next_priority, _, next_content, next_kwargs, next_future = target.queue[0]
+                        if next_priority != priority or not self._mergeable(next_content, next_kwargs) or next_kwargs != kwargs or len(content) + len(next_content) + 2 > 2000:
+                            break
+                        heapq.heappop(target.queue)
+                        content += "\n\n" + next_content
+                        futures.append(next_future)
+                        self.merged += 1
+                if all(f.done() for f in futures):
+                    continue
+                # wait until the oldest of the last `rate` messages is `per` seconds old
+                if len(target.sent) == target.rate:
+                    wait = target.per - (time.monotonic() - target.sent[0])
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                await self.gate.acquire(priority)
+                try:
+                    with metrics.timer("jetlag_send_seconds", kind=key[0]):
+                        message = await target.send(content, **kwargs)
+                except Exception as e:
+                    for f in futures:
+                        if not f.done():
+                            f.set_exception(e)
+                else:
+                    for f in futures:
+                        if not f.done():
+                            f.set_result(message)
+                finally:
+                    self.gate.release()
+                    target.sent.append(time.monotonic())
+                    self.sent += 1
+        finally:
+            target.task = None
@@ -0,0 +1,143 @@
+"""Plays random games with the rules from game_core.py, without discord or the internet.
+Prints how many events per second it can do, and how the coins go (what they are spent on, who runs out).
+
+    python3 simulate.py --games 1000 --seed 1
+"""
+import argparse
+import json
+import os
+import random
+import time
+from collections import Counter
+from typing import NamedTuple
+
+import game_core
+from game_core import GameState
+
+class SimCard(NamedTuple):
+    number: int
+    reward: int
+
+def default_cards_path():
+    """The cards file next to this script (it is called Cards.json in the repository, the bot reads cards.json, so both are tried)"""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name in ["cards.json", "Cards.json"]:
+        if os.path.exists(os.path.join(folder, name)):
+            return os.path.join(folder, name)
+    return os.path.join(folder, "cards.json")
+
+def load_cards(path):
+    with open(path, "r") as file:
+        data = json.load(file)
+    return [SimCard(int(number), int(card['Reward'])) for number, card in data.items()]
+
+class Report:
+    """Everything counted over all games"""
+    def __init__(self):
+        self.events = 0
+        self.actions = Counter()
+        self.spent = Counter()
+        self.earned = Counter()
+        self.refused = Counter()
+        self.final_coins = []
+        self.broke_games = 0
+
+def play(rng, cards, report, turns, players=3):
+    """One game: every turn the runner does something random (or gets tagged), the clock goes forward a few minutes"""
+    game = GameState()
+    game.start(range(players), [f"destination {i}" for i in range(players)], rng)
+    now = 0
+    broke = False
+    for turn in range(turns):
+        now += rng.randint(1, 15) * 60
+        runner = next(player for player in game.players if player[2] == "Runner")
+        action = rng.choices(["draw", "finish", "veto", "travel", "shop", "tagged"], weights=[4, 4, 1, 6, 2, 1])[0]
+        if action == "tagged":
+            bonus = game.tagged()
+            if bonus is not None:
+                bonus[3] += game_core.TAGGED_BONUS
+                report.earned["tagged bonus"] += game_core.TAGGED_BONUS
+        elif action == "draw":
+            if game.card_active or game.vetoed(now):
+                report.refused["draw"] += 1
+                continue
+            game.draw(rng.choice(cards))
+        elif action == "finish":
+            if not game.card_active:
+                report.refused["finish"] += 1
+                continue
+            reward = game.finish()
+            runner[3] += reward
+            report.earned["cards"] += reward
+        elif action == "veto":
+            if not game.card_active or game.vetoed(now):
+                report.refused["veto"] += 1
+                continue
+            game.veto(now)
+        elif action == "travel":
+            if game.vetoed(now):
+                report.refused["travel"] += 1
+                continue
+            method = rng.choice(list(game_core.TRAVEL_COSTS))
+            cost = game_core.travel_cost(method, rng.randint(5, 90))
+            if cost > runner[3]:
+                report.refused["travel (coins)"] += 1
+                broke = True
+                continue
+            runner[3] -= cost
+            report.spent[method] += cost
+        elif action == "shop":
+            if game.vetoed(now):
+                report.refused["shop"] += 1
+                continue
+            item = rng.choice(list(game_core.SHOP_PRICES))
+            price = game_core.SHOP_PRICES[item]
+            if price > runner[3]:
+                report.refused["shop (coins)"] += 1
+                broke = True
+                continue
+            runner[3] -= price
+            report.spent[item] += price
+            if item == "double":
+                game.buy_double()
+        report.actions[action] += 1
+        report.events += 1
+    report.final_coins.extend(player[3] for player in game.players)
+    report.broke_games += broke
+
+def print_report(report, games, seconds):
+    print(f"{games} games, {report.events} events in {seconds:.2f}s: {report.events / seconds:,.0f} events/sec, {games / seconds:,.0f} games/sec\n")
+    print("Actions:")
+    for action, count in report.actions.most_common():
+        print(f"    {action}: {count}")
+    print("Refused (not allowed right now, or not enough coins):")
+    for action, count in report.refused.most_common():
+        print(f"    {action}: {count}")
+    print("Coins earned:")
+    for source, coins in report.earned.most_common():
+        print(f"    {source}: {coins}")
+    print("Coins spent:")
+    for item, coins in report.spent.most_common():
+        print(f"    {item}: {coins}")
+    coins = sorted(report.final_coins)
+    print(f"Coins at the end (start {game_core.START_COINS}): min {coins[0]}, median {coins[len(coins) // 2]}, mean {sum(coins) / len(coins):.0f}, max {coins[-1]}")
+    print(f"Games where a runner couldn't pay for something: {report.broke_games} ({100 * report.broke_games / games:.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Play random games to measure the game rules and the economy")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=200, help="actions per game")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--cards", default=default_cards_path())
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cards = load_cards(args.cards)
+    report = Report()
+    begin = time.perf_counter()
+    for _ in range(args.games):
+        play(rng, cards, report, args.turns)
+    print_report(report, args.games, time.perf_counter() - begin)
+
+if __name__ == "__main__":
+    main()
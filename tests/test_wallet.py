@@ -0,0 +1,100 @@
+"""Stress tests for the Wallet: a lot of payments at the same time, like buttons pressed at once.
+
+    python3 -m unittest discover tests
+"""
+import asyncio
+import os
+import random
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_core import Wallet
+
+def make_players(count, coins):
+    return [[SimpleNamespace(id=i), f"destination {i}", "Runner" if i == 0 else "Chaser", coins] for i in range(count)]
+
+class WalletStressTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_debits_never_overspend(self):
+        players = make_players(3, 1000)
+        wallet = Wallet()
+        wallet.reset(players)
+        member = players[0][0]
+
+        async def buy(amount):
+            # give the other payments a chance to run in between
+            await asyncio.sleep(random.random() / 1000)
+            return await wallet.debit(member, amount)
+
+        results = await asyncio.gather(*[buy(random.choice([1, 5, 25, 100])) for _ in range(2000)])
+        statuses = {status for status, _ in results}
+        self.assertLessEqual(statuses, {"ok", "insufficient"})
+        self.assertGreaterEqual(wallet.balance(member), 0)
+        self.assertIn("insufficient", statuses)
+
+    async def test_balance_matches_successful_payments(self):
+        players = make_players(3, 5000)
+        wallet = Wallet()
+        wallet.reset(players)
+        member = players[1][0]
+        amounts = [random.randint(1, 200) for _ in range(1000)]
+        results = await asyncio.gather(*[wallet.debit(member, amount) for amount in amounts])
+        paid = sum(amount for amount, (status, _) in zip(amounts, results) if status == "ok")
+        self.assertEqual(wallet.balance(member), 5000 - paid)
+
+    async def test_one_key_pays_once(self):
+        players = make_players(3, 10000)
+        wallet = Wallet()
+        wallet.reset(players)
+        member = players[0][0]
+        results = await asyncio.gather(*[wallet.debit(member, 250, key="shop:1") for _ in range(500)])
+        self.assertEqual(sum(status == "ok" for status, _ in results), 1)
+        self.assertEqual(sum(status == "duplicate" for status, _ in results), 499)
+        self.assertEqual(wallet.balance(member), 10000 - 250)
+
+    async def test_insufficient_doesnt_use_up_the_key(self):
+        players = make_players(3, 500)
+        wallet = Wallet()
+        wallet.reset(players)
+        member = players[0][0]
+        self.assertEqual(await wallet.debit(member, 1000, key="shop:1"), ("insufficient", 500))
+        self.assertEqual(await wallet.debit(member, 250, key="shop:1"), ("ok", 250))
+        self.assertEqual(await wallet.debit(member, 250, key="shop:1"), ("duplicate", 250))
+
+    async def test_unknown_member(self):
+        wallet = Wallet()
+        wallet.reset(make_players(3, 100))
+        self.assertEqual(await wallet.debit(SimpleNamespace(id=99), 10, key="travel:1"), ("unknown", None))
+
+    async def test_credits_and_debits_from_many_players(self):
+        players = make_players(3, 1000)
+        changes = []
+        wallet = Wallet(on_change=lambda row: changes.append(row[3]))
+        wallet.reset(players)
+
+        async def play(player):
+            expected = player[3]
+            paid = 0
+            for _ in range(200):
+                await asyncio.sleep(0)
+                if random.random() < 0.5:
+                    status, _ = await wallet.credit(player[0], 10)
+                    expected += 10
+                else:
+                    status, _ = await wallet.debit(player[0], 15)
+                    if status == "ok":
+                        expected -= 15
+                paid += status == "ok"
+            return expected, paid
+
+        results = await asyncio.gather(*[play(player) for player in players])
+        for player, (expected, _) in zip(players, results):
+            self.assertEqual(player[3], expected)
+            self.assertGreaterEqual(player[3], 0)
+        # every change that went through was reported (so it was saved)
+        self.assertEqual(len(changes), sum(paid for _, paid in results))
+
+if __name__ == "__main__":
+    unittest.main()